@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import random
+import string
+import argparse
+import tempfile
+import resource
+
+import six
+import lmdb
+import torch
+import torch.utils.data
+from PIL import Image, ImageDraw, ImageFont
+
+import ocrodeg
+from dataset import hierarchical_dataset, AlignCollate, lmdb_worker_init_fn, iter_leaf_datasets, resize_to_array
+from lmdb_meta import metaKey, pack_meta, NUM_META_KEY
+
+
+def create_synthetic_lmdb(outputPath, num_samples=2000, character=string.digits + string.ascii_lowercase,
+                          max_length=25, seed=1111):
+    """ render random strings into a small LMDB dataset, so the benchmark runs offline and reproducibly """
+    os.makedirs(outputPath, exist_ok=True)
+    rng = random.Random(seed)
+    font = ImageFont.load_default()
+    env = lmdb.open(outputPath, map_size=1 << 30)
+    with env.begin(write=True) as txn:
+        for cnt in range(1, num_samples + 1):
+            label = ''.join(rng.choice(character) for _ in range(rng.randint(1, max_length)))
+            img = Image.new('L', (8 * len(label) + rng.randint(4, 40), rng.randint(16, 48)), rng.randint(200, 255))
+            ImageDraw.Draw(img).text((2, 2), label, fill=rng.randint(0, 60), font=font)
+            buf = six.BytesIO()
+            img.save(buf, format='JPEG' if cnt % 2 else 'PNG')
+            imageBin = buf.getvalue()
+            txn.put('image-%09d'.encode() % cnt, imageBin)
+            txn.put('label-%09d'.encode() % cnt, label.encode())
+            txn.put(metaKey(cnt), pack_meta(imageBin, label))
+        txn.put('num-samples'.encode(), str(num_samples).encode())
+        txn.put(NUM_META_KEY, str(num_samples).encode())
+    env.close()
+
+
+def worker_peak_rss_mb(loader_iter):
+    """ peak RSS (VmHWM) of each DataLoader worker process, read from /proc while the workers are alive """
+    peak_rss = []
+    for worker in getattr(loader_iter, '_workers', []):
+        try:
+            with open(f'/proc/{worker.pid}/status', 'r') as fp:
+                for line in fp:
+                    if line.startswith('VmHWM:'):
+                        peak_rss.append(int(line.split()[1]) / 1024)
+        except OSError:
+            pass
+    return peak_rss
+
+
+def benchmark_loader(opt, workers, batch_size, augment, PAD):
+    """ samples/sec of hierarchical_dataset + AlignCollate through a DataLoader, without any model """
+    opt.workers, opt.augment, opt.PAD = workers, augment, PAD
+    dataset, _ = hierarchical_dataset(root=opt.data_dir, opt=opt)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size,
+        shuffle=True,
+        num_workers=workers,
+        collate_fn=AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=PAD, augment=augment),
+        pin_memory=False,
+        worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
+
+    loader_iter = iter(loader)
+    next(loader_iter)  # warm up, workers are started here
+    n_samples = 0
+    start_time = time.time()
+    for _ in range(opt.num_batches):
+        try:
+            image_tensors, labels = next(loader_iter)
+        except StopIteration:
+            loader_iter = iter(loader)
+            image_tensors, labels = next(loader_iter)
+        n_samples += image_tensors.size(0)
+    elapsed_time = time.time() - start_time
+    peak_rss = worker_peak_rss_mb(loader_iter)
+    del loader_iter
+    return n_samples / elapsed_time, peak_rss
+
+
+def profile_stages(opt, num_samples=256):
+    """ per-sample time of each stage, measured in this process on the first lmdb of opt.data_dir """
+    opt.augment, opt.PAD = False, False
+    dataset, _ = hierarchical_dataset(root=opt.data_dir, opt=opt)
+    lmdb_dataset = next(iter_leaf_datasets(dataset))
+    indices = random.sample(range(len(lmdb_dataset)), min(num_samples, len(lmdb_dataset)))
+    stage_time = {'lmdb fetch': 0.0, 'decode': 0.0, 'augment': 0.0, 'resize': 0.0, 'resize (PAD)': 0.0, 'collate': 0.0}
+
+    samples = []
+    for position in indices:
+        index = int(lmdb_dataset.filtered_index_list[position])
+        start_time = time.time()
+        labelbuf, imgbuf = lmdb_dataset.read_buffers(index)
+        stage_time['lmdb fetch'] += time.time() - start_time
+
+        start_time = time.time()
+        img, label = lmdb_dataset.decode_sample(index, labelbuf, imgbuf)
+        stage_time['decode'] += time.time() - start_time
+        samples.append((img, label))
+
+        start_time = time.time()
+        ocrodeg.ocrodeg_simple_augment(img)
+        stage_time['augment'] += time.time() - start_time
+
+        start_time = time.time()
+        resize_to_array(img, opt.imgH, opt.imgW)
+        stage_time['resize'] += time.time() - start_time
+
+        start_time = time.time()
+        resize_to_array(img, opt.imgH, opt.imgW, keep_ratio_with_pad=True)
+        stage_time['resize (PAD)'] += time.time() - start_time
+
+    start_time = time.time()
+    AlignCollate(imgH=opt.imgH, imgW=opt.imgW)(samples)
+    stage_time['collate'] += time.time() - start_time  # includes resize
+
+    return {k: v / len(indices) * 1000 for k, v in stage_time.items()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='lmdb dataset root, a synthetic lmdb is created in a temporary directory if not given')
+    parser.add_argument('--num_samples', type=int, default=2000, help='number of samples of the synthetic lmdb')
+    parser.add_argument('--workers', type=str, default='0-2-4', help='number of data loading workers to sweep')
+    parser.add_argument('--batch_size', type=str, default='64-192', help='batch sizes to sweep')
+    parser.add_argument('--num_batches', type=int, default=20, help='number of timed batches per setting')
+    parser.add_argument('--batch_max_length', type=int, default=25, help='maximum-label-length')
+    parser.add_argument('--imgH', type=int, default=32, help='the height of the input image')
+    parser.add_argument('--imgW', type=int, default=100, help='the width of the input image')
+    parser.add_argument('--rgb', action='store_true', help='use rgb input')
+    parser.add_argument('--character', type=str, default='0123456789abcdefghijklmnopqrstuvwxyz', help='character label')
+    parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
+    parser.add_argument('--data_filtering_off', action='store_true', help='for data_filtering_off mode')
+    parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'pil_draft', 'cv2'],
+                        help='image decoder, pil_draft and cv2 decode large images at a reduced size covering imgH x imgW')
+    parser.add_argument('--lazy_lmdb', action='store_true',
+                        help='open lmdb lazily in each DataLoader worker and reuse one read transaction per worker')
+    parser.add_argument('--use_variants', action='store_true',
+                        help='read a random pre-rendered variant of each image from lmdbs made by create_augmented_lmdb.py')
+    parser.add_argument('--log', type=str, default=None, help='append the results to this file')
+    opt = parser.parse_args()
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+    random.seed(1111)
+    torch.manual_seed(1111)
+
+    tmp_dir = None
+    if opt.data_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        opt.data_dir = tmp_dir.name
+        create_synthetic_lmdb(os.path.join(opt.data_dir, 'synthetic'), opt.num_samples, opt.character,
+                              opt.batch_max_length)
+
+    dashed_line = '-' * 80
+    result_log = f'{dashed_line}\nper-sample stage time (ms)\n{dashed_line}\n'
+    for stage, ms in profile_stages(opt).items():
+        result_log += f'{stage:17s}: {ms:0.3f}\n'
+
+    result_log += f'{dashed_line}\n{"workers":>7s} {"batch":>6s} {"augment":>8s} {"PAD":>6s} {"samples/s":>10s} {"max worker peak RSS (MB)":>25s}\n{dashed_line}\n'
+    for workers in map(int, opt.workers.split('-')):
+        for batch_size in map(int, opt.batch_size.split('-')):
+            for augment in [False, True]:
+                for PAD in [False, True]:
+                    samples_per_sec, peak_rss = benchmark_loader(opt, workers, batch_size, augment, PAD)
+                    peak_rss = f'{max(peak_rss):0.1f}' if peak_rss else 'n/a'
+                    result_log += f'{workers:7d} {batch_size:6d} {str(augment):>8s} {str(PAD):>6s} {samples_per_sec:10.1f} {peak_rss:>25s}\n'
+    result_log += f'{dashed_line}\nmain process peak RSS (MB): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:0.1f}'
+
+    print(result_log)
+    if opt.log is not None:
+        with open(opt.log, 'a', encoding='utf-8') as log:
+            log.write(result_log + '\n')
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import lmdb
+import numpy as np
+
+from image_decoder import decode_image, DECODERS
+from dataset import resize_to_array
+from benchmark_data_pipeline import create_synthetic_lmdb
+
+
+def read_image_buffers(root, num_samples, seed=1111):
+    """ read num_samples random image buffers of a lmdb dataset into memory, so only decoding is timed """
+    env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+    with env.begin(write=False) as txn:
+        nSamples = int(txn.get('num-samples'.encode()))
+        indices = random.Random(seed).sample(range(1, nSamples + 1), min(num_samples, nSamples))
+        imgbufs = [txn.get('image-%09d'.encode() % index) for index in indices]
+    env.close()
+    return imgbufs
+
+
+def benchmark_decoder(imgbufs, backend, opt, reference=None):
+    """
+    per-sample decode and decode + resize time (ms) of one backend,
+    and the mean absolute difference of the resized images to the reference (0-255 scale)
+    """
+    target_size = (opt.imgW, opt.imgH)
+    decode_time, resize_time = 0.0, 0.0
+    arrays = []
+    for imgbuf in imgbufs:
+        start_time = time.time()
+        img = decode_image(imgbuf, opt.rgb, target_size, backend)
+        decode_time += time.time() - start_time
+
+        start_time = time.time()
+        arrays.append(resize_to_array(img, opt.imgH, opt.imgW, keep_ratio_with_pad=opt.PAD))
+        resize_time += time.time() - start_time
+
+    diff = 0.0
+    if reference is not None:
+        diff = np.mean([np.abs(a.astype(np.float32) - r.astype(np.float32)).mean() for a, r in zip(arrays, reference)])
+    n = len(imgbufs)
+    return decode_time / n * 1000, (decode_time + resize_time) / n * 1000, diff, arrays
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='lmdb dataset path, a synthetic lmdb is created in a temporary directory if not given')
+    parser.add_argument('--num_samples', type=int, default=1000, help='number of images to decode')
+    parser.add_argument('--decoders', type=str, default='-'.join(DECODERS),
+                        help='decoders to compare, put pil first to get the difference to it')
+    parser.add_argument('--imgH', type=int, default=32, help='the height of the input image')
+    parser.add_argument('--imgW', type=int, default=100, help='the width of the input image')
+    parser.add_argument('--rgb', action='store_true', help='use rgb input')
+    parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--log', type=str, default=None, help='append the results to this file')
+    opt = parser.parse_args()
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+
+    tmp_dir = None
+    if opt.data_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        opt.data_dir = os.path.join(tmp_dir.name, 'synthetic')
+        create_synthetic_lmdb(opt.data_dir, opt.num_samples)
+
+    imgbufs = read_image_buffers(opt.data_dir, opt.num_samples)
+    dashed_line = '-' * 80
+    result_log = f'{dashed_line}\n{len(imgbufs)} images of {opt.data_dir}, resized to {opt.imgH}x{opt.imgW}, PAD: {opt.PAD}\n'
+    result_log += f'{dashed_line}\n{"decoder":>10s} {"decode (ms)":>12s} {"decode+resize (ms)":>19s} {"mean abs diff to pil":>21s}\n{dashed_line}\n'
+
+    reference = None
+    for backend in opt.decoders.split('-'):
+        try:
+            decode_ms, total_ms, diff, arrays = benchmark_decoder(imgbufs, backend, opt, reference)
+        except ImportError as e:
+            result_log += f'{backend:>10s} skipped: {e}\n'
+            continue
+        if backend == 'pil':
+            reference = arrays
+        diff = f'{diff:0.3f}' if reference is not None and reference is not arrays else '-'
+        result_log += f'{backend:>10s} {decode_ms:12.3f} {total_ms:19.3f} {diff:>21s}\n'
+    result_log += dashed_line
+
+    print(result_log)
+    if opt.log is not None:
+        with open(opt.log, 'a', encoding='utf-8') as log:
+            log.write(result_log + '\n')
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+import img_utils
+from benchmark_ocrodeg import render_text_image, run
+
+
+#
+# the per-pixel loop implementations img_utils.py had before vectorization, kept as the reference
+#
+
+def reference_salt_and_pepper_noise(img, proportion=0.05):
+    noise_img = np.array(img)
+    height, width = noise_img.shape
+    num = int(height * width * proportion)
+    for i in range(num):
+        w = random.randint(0, width - 1)
+        h = random.randint(0, height - 1)
+        if random.randint(0, 1) == 0:
+            noise_img[h, w] = 0
+        else:
+            noise_img[h, w] = 255
+    return Image.fromarray(noise_img)
+
+
+def reference_gauss_noise(image):
+    image = np.array(image)
+    img = image.astype(np.int16)
+    for i in range(img.shape[0]):
+        for j in range(img.shape[1]):
+            img[i, j] = img[i, j] + random.gauss(mu=0, sigma=10)
+    img[img > 255] = 255
+    img[img < 0] = 0
+    return Image.fromarray(img.astype(np.uint8))
+
+
+def reference_img_augment(img, crop_threshold=0.3, blur_threshold=0.3, salt_pepper_threshold=0.5, gauss_threshold=0.5):
+    w, h = img.size
+    if random.random() < crop_threshold:
+        multiplier = random.uniform(1.0, 1.2)
+        nw = int(multiplier * w) + 1
+        nh = int(multiplier * h) + 1
+        img = img.resize((nw, nh), Image.BICUBIC)
+        shift_x = random.randint(0, max(nw - w - 1, 0))
+        shift_y = random.randint(0, max(nh - h - 1, 0))
+        img = img.crop((shift_x, shift_y, shift_x + w, shift_y + h))
+    if random.random() < blur_threshold:
+        img = img.filter(ImageFilter.GaussianBlur(radius=random.choice([1, 1.5, 2])))
+    if random.random() < salt_pepper_threshold:
+        img = reference_salt_and_pepper_noise(img)
+    if random.random() < gauss_threshold:
+        img = reference_gauss_noise(img)
+    return img
+
+
+def benchmark_cases(img):
+    """ name -> (reference call, vectorized call) """
+    return {
+        'salt_and_pepper_noise': (lambda: np.array(reference_salt_and_pepper_noise(img)),
+                                  lambda: np.array(img_utils.salt_and_pepper_noise(img))),
+        'gauss_noise': (lambda: np.array(reference_gauss_noise(img)),
+                        lambda: np.array(img_utils.gauss_noise(img))),
+        'img_augment': (lambda: np.array(reference_img_augment(img)),
+                        lambda: np.array(img_utils.img_augment(img))),
+        'img_augment (all ops)': (lambda: np.array(reference_img_augment(img, 1, 1, 1, 1)),
+                                  lambda: np.array(img_utils.img_augment(img, 1, 1, 1, 1))),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--canvas_size', type=int, default=64, help='height and width of the benchmark image')
+    parser.add_argument('--repeat', type=int, default=100, help='number of calls per function')
+    parser.add_argument('--log', type=str, default=None, help='append the results to this file')
+    opt = parser.parse_args()
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+    random.seed(1111)
+    np.random.seed(1111)
+    img = Image.fromarray((render_text_image((opt.canvas_size, opt.canvas_size)) * 255).astype(np.uint8))
+
+    dashed_line = '-' * 100
+    result_log = f'{dashed_line}\nimage {opt.canvas_size}x{opt.canvas_size}, {opt.repeat} calls per function\n'
+    result_log += f'{dashed_line}\n{"function":22s} {"reference (ms)":>15s} {"vectorized (ms)":>16s} {"speedup":>8s}   ' \
+                  f'output mean / std / q01 / q99, reference | vectorized\n{dashed_line}\n'
+    for name, (reference, vectorized) in benchmark_cases(img).items():
+        reference_ms, reference_stats = run(reference, opt.repeat)
+        vectorized_ms, vectorized_stats = run(vectorized, opt.repeat)
+        reference_stats = ' '.join(f'{x:0.3f}' for x in reference_stats)
+        vectorized_stats = ' '.join(f'{x:0.3f}' for x in vectorized_stats)
+        result_log += f'{name:22s} {reference_ms:15.3f} {vectorized_ms:16.3f} {reference_ms / vectorized_ms:7.1f}x   ' \
+                      f'{reference_stats} | {vectorized_stats}\n'
+    result_log += dashed_line
+
+    print(result_log)
+    if opt.log is not None:
+        with open(opt.log, 'a', encoding='utf-8') as log:
+            log.write(result_log + '\n')
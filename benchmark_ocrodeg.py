@@ -0,0 +1,208 @@
+import os
+import sys
+import time
+import random
+import argparse
+import warnings
+
+import numpy as np
+import scipy.ndimage as ndi
+from PIL import Image, ImageDraw, ImageFont
+
+import ocrodeg
+
+
+#
+# the loop based implementations ocrodeg.py had before vectorization, kept as the reference
+#
+
+def reference_make_noise_at_scale(shape, scale):
+    h, w = shape
+    h0, w0 = int(h / scale + 1), int(w / scale + 1)
+    data = np.random.rand(h0, w0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        result = ndi.zoom(data, scale)
+    return result[:h, :w]
+
+
+def reference_make_multiscale_noise(shape, scales, weights=None, limits=(0.0, 1.0)):
+    if weights is None:
+        weights = [1.0] * len(scales)
+    result = reference_make_noise_at_scale(shape, scales[0]) * weights[0]
+    for s, w in zip(scales, weights):
+        result += reference_make_noise_at_scale(shape, s) * w
+    lo, hi = limits
+    result -= np.amin(result)
+    result /= np.amax(result)
+    result *= (hi - lo)
+    result += lo
+    return result
+
+
+def reference_make_multiscale_noise_uniform(shape, srange=(1.0, 100.0), nscales=4, limits=(0.0, 1.0)):
+    lo, hi = np.log10(srange[0]), np.log10(srange[1])
+    scales = np.random.uniform(size=nscales)
+    scales = np.add.accumulate(scales)
+    scales -= np.amin(scales)
+    scales /= np.amax(scales)
+    scales *= hi - lo
+    scales += lo
+    scales = 10 ** scales
+    weights = 2.0 * np.random.uniform(size=nscales)
+    return reference_make_multiscale_noise(shape, scales, weights=weights, limits=limits)
+
+
+def reference_random_blobs(shape, blobdensity, size, roughness=2.0):
+    h, w = shape
+    numblobs = int(blobdensity * w * h)
+    mask = np.zeros((h, w), 'i')
+    for i in range(numblobs):
+        mask[random.randint(0, h - 1), random.randint(0, w - 1)] = 1
+    dt = ndi.distance_transform_edt(1 - mask)
+    mask = np.array(dt < size, 'f')
+    mask = ndi.gaussian_filter(mask, size / (2 * roughness))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mask -= np.amin(mask)
+        mask /= np.amax(mask)
+        noise = np.random.rand(h, w)
+        noise = ndi.gaussian_filter(noise, size / (2 * roughness))
+        noise -= np.amin(noise)
+        noise /= np.amax(noise)
+        return np.array(mask * noise > 0.5, 'f')
+
+
+def reference_random_blotches(image, fgblobs, bgblobs, fgscale=10, bgscale=10):
+    fg = reference_random_blobs(image.shape, fgblobs, fgscale)
+    bg = reference_random_blobs(image.shape, bgblobs, bgscale)
+    return np.minimum(np.maximum(image, fg), 1 - bg)
+
+
+def reference_make_fiber(l, a, stepsize=0.5):
+    angles = np.random.standard_cauchy(l) * a
+    angles[0] += 2 * np.pi * np.random.rand()
+    angles = np.add.accumulate(angles)
+    coss = np.add.accumulate(np.cos(angles) * stepsize)
+    sins = np.add.accumulate(np.sin(angles) * stepsize)
+    return np.array([coss, sins]).transpose((1, 0))
+
+
+def reference_make_fibrous_image(shape, nfibers=300, l=300, a=0.2, stepsize=0.5, limits=(0.1, 1.0), blur=1.0):
+    h, w = shape
+    lo, hi = limits
+    result = np.zeros(shape)
+    for i in range(nfibers):
+        v = np.random.rand() * (hi - lo) + lo
+        fiber = reference_make_fiber(l, a, stepsize=stepsize)
+        y, x = random.randint(0, h - 1), random.randint(0, w - 1)
+        fiber[:, 0] += y
+        fiber[:, 0] = np.clip(fiber[:, 0], 0, h - .1)
+        fiber[:, 1] += x
+        fiber[:, 1] = np.clip(fiber[:, 1], 0, w - .1)
+        for y, x in fiber:
+            result[int(y), int(x)] = v
+    result = ndi.gaussian_filter(result, blur)
+    result -= np.amin(result)
+    result /= np.amax(result)
+    result *= (hi - lo)
+    result += lo
+    return result
+
+
+def reference_printlike_multiscale(image, blur=0.5, blotches=5e-5, paper_range=(0.8, 1.0), ink_range=(0.0, 0.2)):
+    selector = ocrodeg.autoinvert(image)
+    selector = reference_random_blotches(selector, 2 * blotches, blotches)
+    paper = reference_make_multiscale_noise_uniform(image.shape, limits=paper_range)
+    ink = reference_make_multiscale_noise_uniform(image.shape, limits=ink_range)
+    blurred = ndi.gaussian_filter(selector, blur)
+    printed = blurred * ink + (1 - blurred) * paper
+    return printed
+
+
+def reference_printlike_fibrous(image, blur=0.5, blotches=5e-5, paper_range=(0.8, 1.0), ink_range=(0.0, 0.2)):
+    selector = ocrodeg.autoinvert(image)
+    selector = reference_random_blotches(selector, 2 * blotches, blotches)
+    paper = reference_make_multiscale_noise(image.shape, [1.0, 5.0, 10.0, 50.0], weights=[1.0, 0.3, 0.5, 0.3],
+                                            limits=paper_range)
+    paper -= reference_make_fibrous_image(image.shape, 300, 500, 0.01, limits=(0.0, 0.25), blur=0.5)
+    ink = reference_make_multiscale_noise(image.shape, [1.0, 5.0, 10.0, 50.0], limits=ink_range)
+    blurred = ndi.gaussian_filter(selector, blur)
+    printed = blurred * ink + (1 - blurred) * paper
+    return printed
+
+
+def render_text_image(shape, seed=1111):
+    """ a [0, 1] float image of black random text on white, standing in for a text line """
+    rng = random.Random(seed)
+    h, w = shape
+    img = Image.new('L', (w, h), 255)
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default()
+    for y in range(2, h - 10, 14):
+        draw.text((2, y), ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789 ') for _ in range(w // 6)),
+                  fill=0, font=font)
+    return np.array(img) / 255
+
+
+def benchmark_cases(shape, blobdensity):
+    """ name -> (reference call, vectorized call) """
+    image = render_text_image(shape)
+    return {
+        'make_fibrous_image': (lambda: reference_make_fibrous_image(shape, 300, 500, 0.01, limits=(0.0, 0.25), blur=0.5),
+                               lambda: ocrodeg.make_fibrous_image(shape, 300, 500, 0.01, limits=(0.0, 0.25), blur=0.5)),
+        'random_blobs': (lambda: reference_random_blobs(shape, blobdensity, 10),
+                         lambda: ocrodeg.random_blobs(shape, blobdensity, 10)),
+        'make_multiscale_noise': (
+            lambda: reference_make_multiscale_noise(shape, [1.0, 5.0, 10.0, 50.0], weights=[1.0, 0.3, 0.5, 0.3]),
+            lambda: ocrodeg.make_multiscale_noise(shape, [1.0, 5.0, 10.0, 50.0], weights=[1.0, 0.3, 0.5, 0.3])),
+        'printlike_multiscale': (lambda: reference_printlike_multiscale(image),
+                                 lambda: ocrodeg.printlike_multiscale(image)),
+        'printlike_fibrous': (lambda: reference_printlike_fibrous(image),
+                              lambda: ocrodeg.printlike_fibrous(image)),
+    }
+
+
+def run(function, repeat):
+    """ mean time (ms) of repeat calls, and mean / std / 1% and 99% quantiles of all the outputs """
+    outputs = []
+    start_time = time.time()
+    for _ in range(repeat):
+        outputs.append(function())
+    elapsed_time = (time.time() - start_time) / repeat * 1000
+    values = np.concatenate([output.reshape(-1) for output in outputs])
+    return elapsed_time, (values.mean(), values.std(), np.quantile(values, 0.01), np.quantile(values, 0.99))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=64, help='height of the benchmark image')
+    parser.add_argument('--width', type=int, default=512, help='width of the benchmark image')
+    parser.add_argument('--repeat', type=int, default=20, help='number of calls per function')
+    parser.add_argument('--blobdensity', type=float, default=1e-4, help='blob density of random_blobs')
+    parser.add_argument('--log', type=str, default=None, help='append the results to this file')
+    opt = parser.parse_args()
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+    random.seed(1111)
+    np.random.seed(1111)
+
+    dashed_line = '-' * 100
+    result_log = f'{dashed_line}\nimage {opt.height}x{opt.width}, {opt.repeat} calls per function\n'
+    result_log += f'{dashed_line}\n{"function":22s} {"reference (ms)":>15s} {"vectorized (ms)":>16s} {"speedup":>8s}   ' \
+                  f'output mean / std / q01 / q99, reference | vectorized\n{dashed_line}\n'
+    for name, (reference, vectorized) in benchmark_cases((opt.height, opt.width), opt.blobdensity).items():
+        reference_ms, reference_stats = run(reference, opt.repeat)
+        vectorized_ms, vectorized_stats = run(vectorized, opt.repeat)
+        reference_stats = ' '.join(f'{x:0.3f}' for x in reference_stats)
+        vectorized_stats = ' '.join(f'{x:0.3f}' for x in vectorized_stats)
+        result_log += f'{name:22s} {reference_ms:15.2f} {vectorized_ms:16.2f} {reference_ms / vectorized_ms:7.1f}x   ' \
+                      f'{reference_stats} | {vectorized_stats}\n'
+    result_log += dashed_line
+
+    print(result_log)
+    if opt.log is not None:
+        with open(opt.log, 'a', encoding='utf-8') as log:
+            log.write(result_log + '\n')
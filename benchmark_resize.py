@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from image_decoder import decode_image
+from dataset import resize_batch_pil, resize_batch_tensor, replicate_pad, size_groups
+from benchmark_data_pipeline import create_synthetic_lmdb
+from benchmark_decoders import read_image_buffers
+
+RESIZE_BACKENDS = {'pil': resize_batch_pil, 'tensor': resize_batch_tensor}
+
+
+def resize_all(images, opt, backend, PAD):
+    """ resize the images in batches of opt.batch_size, return the padded uint8 arrays and the samples/sec """
+    resize = RESIZE_BACKENDS[backend]
+    batch_arrays = []
+    start_time = time.time()
+    for start in range(0, len(images), opt.batch_size):
+        batch_array, resized_sizes = resize(images[start:start + opt.batch_size], opt.imgH, opt.imgW, PAD)
+        batch_arrays.append(replicate_pad(batch_array, resized_sizes))
+    elapsed_time = time.time() - start_time
+    return np.concatenate(batch_arrays), len(images) / elapsed_time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='lmdb dataset path, a synthetic lmdb is created in a temporary directory if not given')
+    parser.add_argument('--num_samples', type=int, default=2000, help='number of images to resize')
+    parser.add_argument('--batch_size', type=int, default=192, help='input batch size')
+    parser.add_argument('--imgH', type=int, default=32, help='the height of the input image')
+    parser.add_argument('--imgW', type=int, default=100, help='the width of the input image')
+    parser.add_argument('--rgb', action='store_true', help='use rgb input')
+    parser.add_argument('--sort_by_size', action='store_true',
+                        help='batch images of similar size together, fewer size groups per batch for the tensor backend')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch intra-op threads, torch default if not given')
+    parser.add_argument('--log', type=str, default=None, help='append the results to this file')
+    opt = parser.parse_args()
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_args()
+    if opt.num_threads is not None:
+        torch.set_num_threads(opt.num_threads)
+
+    tmp_dir = None
+    if opt.data_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        opt.data_dir = os.path.join(tmp_dir.name, 'synthetic')
+        create_synthetic_lmdb(opt.data_dir, opt.num_samples)
+
+    images = [decode_image(imgbuf, opt.rgb) for imgbuf in read_image_buffers(opt.data_dir, opt.num_samples)]
+    if opt.sort_by_size:
+        images.sort(key=lambda image: image.size)
+    n_sizes = len(set(image.size for image in images))
+    n_groups = np.mean([len(size_groups(np.array([image.size[::-1] for image in images[start:start + opt.batch_size]])))
+                        for start in range(0, len(images), opt.batch_size)])
+
+    dashed_line = '-' * 80
+    result_log = f'{dashed_line}\n{len(images)} images ({n_sizes} distinct sizes, {n_groups:0.1f} size groups per batch) of {opt.data_dir}, ' \
+                 f'resized to {opt.imgH}x{opt.imgW}, batch size {opt.batch_size}, torch threads {torch.get_num_threads()}\n'
+    result_log += f'{dashed_line}\n{"PAD":>6s} {"pil (samples/s)":>16s} {"tensor (samples/s)":>19s} ' \
+                  f'{"max abs diff":>13s} {"mean abs diff":>14s} {"pixels > 1 off":>15s}\n{dashed_line}\n'
+    for PAD in [False, True]:
+        pil_arrays, pil_speed = resize_all(images, opt, 'pil', PAD)
+        tensor_arrays, tensor_speed = resize_all(images, opt, 'tensor', PAD)
+        diff = np.abs(pil_arrays.astype(np.int16) - tensor_arrays.astype(np.int16))
+        result_log += f'{str(PAD):>6s} {pil_speed:16.1f} {tensor_speed:19.1f} ' \
+                      f'{diff.max():13d} {diff.mean():14.4f} {(diff > 1).mean() * 100:14.3f}%\n'
+    result_log += f'{dashed_line}\ndifferences are on the 0-255 scale, before normalization'
+
+    print(result_log)
+    if opt.log is not None:
+        with open(opt.log, 'a', encoding='utf-8') as log:
+            log.write(result_log + '\n')
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
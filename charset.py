@@ -0,0 +1,124 @@
+import os
+import string
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+CHARSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'charset')
+CHARSET_NAMES = ['CN-s', 'CN-m', 'CN-l', 'CN-xl']
+PRINTABLE_CHARACTER = string.printable[:-6]  # same with ASTER setting (use 94 char).
+# user cache, the source tree may be read-only or shared
+CHARSET_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                 'deep-text-recognition-benchmark', 'charset')
+
+
+@lru_cache(maxsize=None)
+def read_charset_file(name):
+    """ the character string of CN-s, CN-m, CN-l or CN-xl, one character per line of charset/charset_*.txt """
+    size = name.split('-')[-1]
+    with open(os.path.join(CHARSET_DIR, 'charset_' + size + '.txt'), 'r', encoding='utf-8') as chars:
+        charset = [c.strip() for c in chars]
+    return ''.join(charset)
+
+
+class TranslateTable(dict):
+    """
+    str.translate table which keeps the characters of char_set and deletes all the others,
+    lowercasing them first with lower. Entries are filled on the first lookup of each codepoint,
+    so a label costs one str.translate call, in C for every character seen before.
+    """
+
+    def __init__(self, char_set, lower=False):
+        super(TranslateTable, self).__init__()
+        self.char_set = char_set
+        self.lower = lower
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        if self.lower:
+            char = char.lower()
+        value = ''.join(c for c in char if c in self.char_set) or None  # None deletes the character
+        self[codepoint] = value
+        return value
+
+
+class Charset(object):
+    """
+    The character set of --character with everything the data pipeline and the converters need from it.
+        filter(label, sensitive): the label without the characters out of the charset, lowercased if not sensitive
+        is_valid(label): whether the lowercased label has no character out of the charset (the data filtering)
+        lut: int32 codepoint -> position in character array, -1 for characters out of the charset.
+             It is cached on disk (CHARSET_CACHE_DIR) by the hash of character and memory-mapped,
+             so DataLoader workers share it.
+    Use get_charset, which makes one Charset per character string and process.
+    """
+
+    def __init__(self, character, cache_dir=CHARSET_CACHE_DIR):
+        self.character = character
+        self.hash = hashlib.sha1(character.encode('utf-8')).hexdigest()
+        self.char_set = frozenset(character)
+        self.chars = list(dict.fromkeys(character))  # unique characters, in order
+        self.filter_table = TranslateTable(self.char_set)
+        self.lower_table = TranslateTable(self.char_set, lower=True)
+        self.cache_path = os.path.join(cache_dir, f'lut_{self.hash[:16]}.npy')
+        self.lut = self.load_lut()
+
+    def __len__(self):
+        return len(self.character)
+
+    def filter(self, label, sensitive=True):
+        return label.translate(self.filter_table if sensitive else self.lower_table)
+
+    def is_valid(self, label):
+        label = label.lower()
+        return len(label.translate(self.filter_table)) == len(label)
+
+    @staticmethod
+    def codepoints(label):
+        return np.frombuffer(label.encode('utf-32-le'), dtype=np.uint32)
+
+    def lookup(self, codepoints):
+        """ positions in character of an array of codepoints, -1 for characters out of the charset """
+        positions = np.full(codepoints.shape, -1, dtype=np.int32)
+        known = codepoints < len(self.lut)
+        positions[known] = self.lut[codepoints[known]]
+        return positions
+
+    def build_lut(self):
+        # a repeated character keeps its last position, like the dicts of the converters
+        positions = {ord(char): i for i, char in enumerate(self.character)}
+        lut = np.full(max(positions, default=-1) + 1, -1, dtype=np.int32)
+        lut[list(positions.keys())] = list(positions.values())
+        return lut
+
+    def load_lut(self):
+        if os.path.isfile(self.cache_path):
+            return np.load(self.cache_path, mmap_mode='r')
+
+        lut = self.build_lut()
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_path, 'wb') as fp:
+                np.save(fp, lut)
+            os.replace(tmp_path, self.cache_path)  # atomic, several processes may build the same cache
+        except OSError as e:
+            print(f'cannot write cache {self.cache_path}: {e}')
+            return lut
+        return np.load(self.cache_path, mmap_mode='r')
+
+    def __getstate__(self):
+        # the lut is memory-mapped again from the cache in each DataLoader worker
+        state = self.__dict__.copy()
+        state['lut'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lut = self.load_lut()
+
+
+@lru_cache(maxsize=16)
+def get_charset(character):
+    return Charset(character)
@@ -0,0 +1,122 @@
+import os
+import sys
+
+import argparse
+import random
+import six
+import lmdb
+from multiprocessing import Pool
+from PIL import Image
+from tqdm import tqdm
+
+import ocrodeg
+from dataset import NUM_VARIANTS_KEY, variantKey
+
+
+def writeCache(env, cache):
+    with env.begin(write=True) as txn:
+        for k, v in cache.items():
+            txn.put(k, v)
+
+
+def _augment_chunk(args):
+    inputPath, start, end, num_variants, rgb, augment_mode, texture_bank, image_format, seed = args
+    # ocrodeg draws from the random module and from rng_utils.get_rng, which is seeded from it
+    random.seed(f'{seed}-{start}')
+    bank = ocrodeg.TextureBank(texture_bank) if texture_bank else None
+    env = lmdb.open(inputPath, max_readers=126, readonly=True, lock=False, readahead=False, meminit=False)
+    results = {}
+    with env.begin(write=False) as txn:
+        for index in range(start, end):
+            imageBin = txn.get('image-%09d'.encode() % index)
+            try:
+                img = Image.open(six.BytesIO(imageBin)).convert('RGB' if rgb else 'L')
+            except IOError:
+                # keep the corrupted image, LmdbDataset replaces it with a dummy sample as before
+                for variant in range(num_variants):
+                    results[variantKey(index, variant)] = imageBin
+                continue
+            for variant in range(num_variants):
+                if augment_mode == 'full':
+                    augmented = ocrodeg.ocrodeg_augment(img, bank)
+                else:
+                    augmented = ocrodeg.ocrodeg_simple_augment(img)
+                buf = six.BytesIO()
+                augmented.save(buf, format=image_format)
+                results[variantKey(index, variant)] = buf.getvalue()
+    env.close()
+    return results
+
+
+def createAugmentedDataset(inputPath, outputPath, num_variants=4, rgb=False, augment_mode='full', texture_bank=None,
+                           image_format='PNG', workers=8, chunk_size=1000, seed=1111, map_size=1099511627776):
+    """
+    Copy a LMDB dataset and add num_variants ocrodeg augmented versions of every image, so the augmentation
+    is computed once instead of in every epoch. Train on it with --use_variants instead of --augment.
+    ARGS:
+        inputPath    : LMDB input path (image-%09d / label-%09d layout)
+        outputPath   : LMDB output path, a copy of the input with 'image-%09d-%03d' variants and 'num-variants'
+        rgb          : augment the rgb images instead of the grayscale ones, same as --rgb of the training,
+                       only with augment_mode 'simple'
+        augment_mode : 'simple' or 'full', same as AlignCollate
+        texture_bank : .npy texture bank for the noise of augment_mode 'full'
+        image_format : PIL format of the variants, PNG is lossless
+        workers      : number of processes which augment the images
+        chunk_size   : number of samples per task
+    """
+    if rgb and augment_mode == 'full':
+        # ocrodeg_augment distorts and adds noise to 2d grayscale arrays only
+        raise ValueError("augment_mode 'full' works on grayscale images, use augment_mode 'simple' with rgb")
+    os.makedirs(outputPath, exist_ok=True)
+    env_in = lmdb.open(inputPath, max_readers=126, readonly=True, lock=False, readahead=False, meminit=False)
+    env_out = lmdb.open(outputPath, map_size=map_size)
+
+    # the original samples, labels and metadata records are copied as they are
+    cache = {}
+    with env_in.begin(write=False) as txn:
+        nSamples = int(txn.get('num-samples'.encode()))
+        with txn.cursor() as cursor:
+            for k, v in tqdm(cursor, desc='copy'):
+                cache[k] = v
+                if len(cache) == 1000:
+                    writeCache(env_out, cache)
+                    cache = {}
+    writeCache(env_out, cache)
+    env_in.close()
+
+    tasks = [(inputPath, start, min(start + chunk_size, nSamples + 1), num_variants, rgb, augment_mode, texture_bank,
+              image_format, seed) for start in range(1, nSamples + 1, chunk_size)]
+    with Pool(workers) as pool:
+        for results in tqdm(pool.imap_unordered(_augment_chunk, tasks), total=len(tasks), desc='augment'):
+            writeCache(env_out, results)
+
+    # written last, a partially augmented lmdb is used without variants
+    writeCache(env_out, {NUM_VARIANTS_KEY: str(num_variants).encode()})
+    env_out.close()
+    print('Created dataset with %d samples and %d variants each' % (nSamples, num_variants))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, required=True, help='LMDB dataset path')
+    parser.add_argument('--output_path', type=str, required=True, help='output LMDB path')
+    parser.add_argument('--num_variants', type=int, default=4, help='number of augmented variants per sample')
+    parser.add_argument('--rgb', action='store_true', help='use rgb input, only with --augment_mode simple')
+    parser.add_argument('--augment_mode', type=str, default='full', choices=['simple', 'full'],
+                        help='simple: binary blur only, full: distort, binary blur and print-like paper / ink noise')
+    parser.add_argument('--texture_bank', type=str, default=None,
+                        help='.npy texture bank (python ocrodeg.py --output_path ...) for the noise of --augment_mode full')
+    parser.add_argument('--image_format', type=str, default='PNG', help='PIL image format of the variants')
+    parser.add_argument('--workers', type=int, default=8, help='number of processes')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='number of samples per task')
+    parser.add_argument('--seed', type=int, default=1111, help='random seed')
+    parser.add_argument('--map_size', type=int, default=1099511627776, help='lmdb dataset size')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    createAugmentedDataset(args.input_path, args.output_path, args.num_variants, args.rgb, args.augment_mode,
+                           args.texture_bank, args.image_format, args.workers, args.chunk_size, args.seed, args.map_size)
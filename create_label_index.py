@@ -0,0 +1,50 @@
+import os
+import sys
+
+import argparse
+import lmdb
+
+from charset import CHARSET_NAMES, PRINTABLE_CHARACTER, read_charset_file
+from dataset import load_label_index
+
+
+def createLabelIndex(root, opt):
+    """
+    Write the label_index / label_offsets sidecars of every LMDB under root for the charset of opt,
+    so training with --label_index reads the labels already encoded for it.
+    ARGS:
+        root : folder of one or more LMDB datasets (image-%09d / label-%09d layout)
+        opt  : character (raw character label) and sensitive, as in training
+    """
+    for dirpath, dirnames, filenames in os.walk(root + '/'):
+        if 'data.mdb' not in filenames:
+            continue
+        env = lmdb.open(dirpath, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+        with env.begin(write=False) as txn:
+            nSamples = int(txn.get('num-samples'.encode()))
+            values, offsets = load_label_index(
+                dirpath, nSamples, opt, lambda index: txn.get('label-%09d'.encode() % index).decode('utf-8'))
+        env.close()
+        print('%s: %d samples, %d label characters' % (dirpath, nSamples, len(values)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='+', help='LMDB dataset paths, searched recursively')
+    parser.add_argument('--character', type=str, nargs='+', default=['0123456789abcdefghijklmnopqrstuvwxyz'],
+                        help='CN-s, CN-m, CN-l, CN-xl or raw character label, one sidecar is written for each')
+    parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for character in args.character:
+        if character in CHARSET_NAMES:
+            character = read_charset_file(character)
+        elif args.sensitive:
+            character = PRINTABLE_CHARACTER  # same with ASTER setting (use 94 char).
+        opt = argparse.Namespace(character=character, sensitive=args.sensitive)
+        for path in args.paths:
+            createLabelIndex(path, opt)
@@ -11,6 +11,8 @@ from tqdm import tqdm
 
 import numpy as np
 
+from lmdb_meta import metaKey, pack_meta, NUM_META_KEY
+
 
 def checkImageIsValid(imageBin):
     if imageBin is None:
@@ -75,6 +77,7 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True, map_size=10995
         labelKey = 'label-%09d'.encode() % cnt
         cache[imageKey] = imageBin
         cache[labelKey] = label.encode()
+        cache[metaKey(cnt)] = pack_meta(imageBin, label)
 
         if cnt % 1000 == 0:
             writeCache(env, cache)
@@ -83,6 +86,7 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True, map_size=10995
         cnt += 1
     nSamples = cnt - 1
     cache['num-samples'.encode()] = str(nSamples).encode()
+    cache[NUM_META_KEY] = str(nSamples).encode()
     writeCache(env, cache)
     print('Created dataset with %d samples' % nSamples)
 
@@ -146,6 +150,7 @@ def createImagenetDataset(inputPath, outputPath, checkValid=True, map_size=10995
         labelKey = 'label-%09d'.encode() % cnt
         cache[imageKey] = imageBin
         cache[labelKey] = label.encode()
+        cache[metaKey(cnt)] = pack_meta(imageBin, label)
 
         if cnt % 1000 == 0:
             writeCache(env, cache)
@@ -154,6 +159,7 @@ def createImagenetDataset(inputPath, outputPath, checkValid=True, map_size=10995
         cnt += 1
     nSamples = cnt-1
     cache['num-samples'.encode()] = str(nSamples).encode()
+    cache[NUM_META_KEY] = str(nSamples).encode()
     writeCache(env, cache)
     print('Created dataset with %d samples' % nSamples)
 
@@ -230,6 +236,7 @@ def createDataset_ICDAR2019(inputPath, outputPath, train_and_eval=True, ratio=0.
                 labelKey = 'label-%09d'.encode() % train_cnt
                 train_cache[imageKey] = imageBin
                 train_cache[labelKey] = label.encode()
+                train_cache[metaKey(train_cnt)] = pack_meta(imageBin, label)
 
                 if train_cnt % 1000 == 0:
                     writeCache(train_env, train_cache)
@@ -241,6 +248,7 @@ def createDataset_ICDAR2019(inputPath, outputPath, train_and_eval=True, ratio=0.
                 labelKey = 'label-%09d'.encode() % val_cnt
                 val_cache[imageKey] = imageBin
                 val_cache[labelKey] = label.encode()
+                val_cache[metaKey(val_cnt)] = pack_meta(imageBin, label)
 
                 if val_cnt % 1000 == 0:
                     writeCache(val_env, val_cache)
@@ -252,6 +260,7 @@ def createDataset_ICDAR2019(inputPath, outputPath, train_and_eval=True, ratio=0.
             labelKey = 'label-%09d'.encode() % cnt
             cache[imageKey] = imageBin
             cache[labelKey] = label.encode()
+            cache[metaKey(cnt)] = pack_meta(imageBin, label)
 
             if cnt % 1000 == 0:
                 writeCache(env, cache)
@@ -261,15 +270,18 @@ def createDataset_ICDAR2019(inputPath, outputPath, train_and_eval=True, ratio=0.
     if train_and_eval:
         nSamples = train_cnt - 1
         train_cache['num-samples'.encode()] = str(nSamples).encode()
+        train_cache[NUM_META_KEY] = str(nSamples).encode()
         writeCache(train_env, train_cache)
         print('Created train dataset with %d samples' % nSamples)
         nSamples = val_cnt - 1
         val_cache['num-samples'.encode()] = str(nSamples).encode()
+        val_cache[NUM_META_KEY] = str(nSamples).encode()
         writeCache(val_env, val_cache)
         print('Created train dataset with %d samples' % nSamples)
     else:
         nSamples = cnt - 1
         cache['num-samples'.encode()] = str(nSamples).encode()
+        cache[NUM_META_KEY] = str(nSamples).encode()
         writeCache(env, cache)
         print('Created dataset with %d samples' % nSamples)
 
@@ -9,6 +9,8 @@ from tqdm import tqdm
 
 import numpy as np
 
+from lmdb_meta import metaKey, pack_meta, NUM_META_KEY
+
 
 def checkImageIsValid(imageBin):
     if imageBin is None:
@@ -97,6 +99,7 @@ def createImageAndGt_Range_Dataset(inputPath, gtPath, train_outputPath, val_outp
             labelKey = 'label-%09d'.encode() % train_cnt
             train_cache[imageKey] = imageBin
             train_cache[labelKey] = label.encode()
+            train_cache[metaKey(train_cnt)] = pack_meta(imageBin, label)
 
             if train_cnt % 1000 == 0:
                 writeCache(train_env, train_cache)
@@ -108,6 +111,7 @@ def createImageAndGt_Range_Dataset(inputPath, gtPath, train_outputPath, val_outp
             labelKey = 'label-%09d'.encode() % val_cnt
             val_cache[imageKey] = imageBin
             val_cache[labelKey] = label.encode()
+            val_cache[metaKey(val_cnt)] = pack_meta(imageBin, label)
 
             if val_cnt % 1000 == 0:
                 writeCache(val_env, val_cache)
@@ -117,10 +121,12 @@ def createImageAndGt_Range_Dataset(inputPath, gtPath, train_outputPath, val_outp
 
     train_nSamples = train_cnt - 1
     train_cache['num-samples'.encode()] = str(train_nSamples).encode()
+    train_cache[NUM_META_KEY] = str(train_nSamples).encode()
     writeCache(train_env, train_cache)
     if val_outputPath is not None:
         val_nSamples = val_cnt - 1
         val_cache['num-samples'.encode()] = str(val_nSamples).encode()
+        val_cache[NUM_META_KEY] = str(val_nSamples).encode()
         writeCache(val_env, val_cache)
 
     if val_outputPath is not None:
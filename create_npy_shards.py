@@ -0,0 +1,90 @@
+import os
+import sys
+
+import argparse
+import json
+import six
+import lmdb
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from dataset import SHARD_META_FILE, resize_to_array
+
+
+def createNpyShards(inputPath, outputPath, imgH=32, imgW=100, PAD=False, rgb=False, shard_size=100000):
+    """
+    Convert a LMDB dataset into memory-mapped .npy shards of pre-resized uint8 images for NpyShardDataset.
+    ARGS:
+        inputPath  : LMDB input path (image-%09d / label-%09d layout)
+        outputPath : output folder of images_%05d.npy, labels.bin, label_offsets.npy and shard_meta.json
+        imgH, imgW, PAD, rgb : the training configuration, images are resized exactly as AlignCollate does
+        shard_size : number of images per .npy shard
+    """
+    os.makedirs(outputPath, exist_ok=True)
+    env = lmdb.open(inputPath, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+    input_channel = 3 if rgb else 1
+
+    with env.begin(write=False) as txn:
+        nSamples = int(txn.get('num-samples'.encode()))
+        num_shards = (nSamples + shard_size - 1) // shard_size
+        label_offsets = np.zeros(nSamples + 1, dtype=np.int64)
+
+        with open(os.path.join(outputPath, 'labels.bin'), 'wb') as label_fp:
+            for shard_idx in range(num_shards):
+                start = shard_idx * shard_size
+                end = min(start + shard_size, nSamples)
+                shard = np.lib.format.open_memmap(
+                    os.path.join(outputPath, 'images_%05d.npy' % shard_idx), mode='w+', dtype=np.uint8,
+                    shape=(end - start, input_channel, imgH, imgW))
+
+                for position in tqdm(range(start, end), desc=f'shard {shard_idx + 1}/{num_shards}'):
+                    index = position + 1  # lmdb starts with 1
+                    label = txn.get('label-%09d'.encode() % index).decode('utf-8')
+                    imgbuf = txn.get('image-%09d'.encode() % index)
+
+                    buf = six.BytesIO()
+                    buf.write(imgbuf)
+                    buf.seek(0)
+                    try:
+                        img = Image.open(buf).convert('RGB' if rgb else 'L')
+                    except IOError:
+                        print(f'Corrupted image for {index}')
+                        # make dummy image and dummy label for corrupted image, same as LmdbDataset
+                        img = Image.new('RGB' if rgb else 'L', (imgW, imgH))
+                        label = '[dummy_label]'
+
+                    shard[position - start] = resize_to_array(img, imgH, imgW, keep_ratio_with_pad=PAD)
+                    label = label.encode('utf-8')
+                    label_fp.write(label)
+                    label_offsets[index] = label_offsets[index - 1] + len(label)
+
+                shard.flush()
+                del shard
+
+    np.save(os.path.join(outputPath, 'label_offsets.npy'), label_offsets)
+    meta = {'num_samples': nSamples, 'num_shards': num_shards, 'shard_size': shard_size,
+            'imgH': imgH, 'imgW': imgW, 'PAD': PAD, 'rgb': rgb}
+    # shard_meta.json is written last, hierarchical_dataset only picks up complete shard sets
+    with open(os.path.join(outputPath, SHARD_META_FILE), 'w', encoding='utf-8') as fp:
+        json.dump(meta, fp, indent=2)
+    print('Created %d shards with %d samples' % (num_shards, nSamples))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, required=True, help='LMDB dataset path')
+    parser.add_argument('--output_path', type=str, required=True, help='output folder path where store npy shards')
+    parser.add_argument('--imgH', type=int, default=32, help='the height of the input image')
+    parser.add_argument('--imgW', type=int, default=100, help='the width of the input image')
+    parser.add_argument('--rgb', action='store_true', help='use rgb input')
+    parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--shard_size', type=int, default=100000, help='number of images per shard')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    createNpyShards(args.input_path, args.output_path, args.imgH, args.imgW, args.PAD, args.rgb, args.shard_size)
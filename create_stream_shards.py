@@ -0,0 +1,63 @@
+import os
+import sys
+
+import argparse
+import json
+import random
+import lmdb
+from tqdm import tqdm
+
+from dataset import STREAM_META_FILE, STREAM_RECORD_HEADER
+
+
+def createStreamShards(inputPath, outputPath, shard_size=20000, shuffle=True):
+    """
+    Convert a LMDB dataset (image-%09d / label-%09d layout) into length-prefixed record shards
+    which StreamShardDataset reads sequentially.
+    ARGS:
+        inputPath  : LMDB input path
+        outputPath : output folder of shard-%05d.rec and stream_meta.json
+        shard_size : number of samples per shard, use at least as many shards as DataLoader workers
+        shuffle    : write the samples in a random order, so each shard is already a mix of the whole dataset
+    """
+    os.makedirs(outputPath, exist_ok=True)
+    env = lmdb.open(inputPath, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+
+    shards = []
+    with env.begin(write=False) as txn:
+        nSamples = int(txn.get('num-samples'.encode()))
+        index_list = list(range(1, nSamples + 1))  # lmdb starts with 1
+        if shuffle:
+            random.shuffle(index_list)
+
+        for start in tqdm(range(0, nSamples, shard_size)):
+            shard = 'shard-%05d.rec' % len(shards)
+            with open(os.path.join(outputPath, shard), 'wb') as fp:
+                for index in index_list[start:start + shard_size]:
+                    label = txn.get('label-%09d'.encode() % index)
+                    imageBin = txn.get('image-%09d'.encode() % index)
+                    fp.write(STREAM_RECORD_HEADER.pack(len(label), len(imageBin)))
+                    fp.write(label)
+                    fp.write(imageBin)
+            shards.append(shard)
+
+    meta = {'num_samples': nSamples, 'shards': shards}
+    with open(os.path.join(outputPath, STREAM_META_FILE), 'w', encoding='utf-8') as fp:
+        json.dump(meta, fp, indent=2)
+    print('Created %d shards with %d samples' % (len(shards), nSamples))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, required=True, help='LMDB dataset path')
+    parser.add_argument('--output_path', type=str, required=True, help='output folder path where store record shards')
+    parser.add_argument('--shard_size', type=int, default=20000, help='number of samples per shard')
+    parser.add_argument('--no_shuffle', action='store_true', help='keep the lmdb order instead of shuffling')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    createStreamShards(args.input_path, args.output_path, args.shard_size, not args.no_shuffle)
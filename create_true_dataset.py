@@ -19,6 +19,7 @@ from torch.utils.data import DataLoader
 from dataset import AlignCollate, PILDataset
 from model import Model
 from utils import CTCLabelConverter, AttnLabelConverter
+from charset import CHARSET_NAMES, PRINTABLE_CHARACTER, read_charset_file
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 IMG_EXT = {'.jpg', '.tif', '.tiff', '.png'}
@@ -322,15 +323,11 @@ if __name__ == '__main__':
     os.makedirs(os.path.join(args.output_path, 'imgs'), exist_ok=True)
     os.makedirs(os.path.join(args.output_path, 'gts'), exist_ok=True)
 
-    if args.character in ['CN-s', 'CN-m', 'CN-l', 'CN-xl']:
-        size = args.character.split('-')[-1]
-        with open('charset/charset_' + size + '.txt', 'r', encoding='utf-8') as chars:
-            charset = [c.strip() for c in chars]
-        charset = ''.join(charset)
-        args.character = charset
+    if args.character in CHARSET_NAMES:
+        args.character = read_charset_file(args.character)
     elif args.sensitive:
         # opt.character += 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        args.character = string.printable[:-6]  # same with ASTER setting (use 94 char).
+        args.character = PRINTABLE_CHARACTER  # same with ASTER setting (use 94 char).
     else:
         raise ValueError
 
@@ -2,6 +2,14 @@ import os
 import random
 import sys
 import re
+import time
+import queue
+import threading
+import hashlib
+import struct
+import json
+import bisect
+from collections import defaultdict, namedtuple
 import six
 import math
 import lmdb
@@ -13,12 +21,17 @@ from natsort import natsorted
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 from torch import nn
-from torch.utils.data import Dataset, ConcatDataset, Subset
+import torch.nn.functional as F
+from torch.utils.data import Dataset, IterableDataset, ConcatDataset, Subset, Sampler
 from torch._utils import _accumulate
 import torchvision.transforms as transforms
 from fontTools.ttLib import TTFont
 
 import ocrodeg
+from charset import get_charset
+from modules.augmentation import BatchAugment
+from lmdb_meta import metaKey, unpack_meta, has_meta
+from image_decoder import decode_image
 from img_utils import img_augment, draw_single_char
 
 
@@ -42,11 +55,15 @@ def processGlyphNames(GlyphNames):
 
 class Batch_Balanced_Dataset(object):
 
-    def __init__(self, opt):
+    def __init__(self, opt, converter=None):
         """
         Modulate the data ratio in the batch.
         For example, when select_data is "MJ-ST" and batch_ratio is "0.5-0.5",
         the 50% of the batch is filled with MJ and the other 50% of the batch is filled with ST.
+        With opt.single_loader, all sources share one DataLoader (one worker pool, one collate call per batch)
+        whose BalancedBatchSampler draws exactly the per-source batch sizes for every batch.
+        With a converter the labels are encoded in the DataLoader workers and get_batch returns
+        (images, labels, text, length) instead of (images, labels).
         """
         log = open(f'./saved_models/{opt.exp_name}/log_dataset.txt', 'a')
         dashed_line = '-' * 80
@@ -55,17 +72,55 @@ class Batch_Balanced_Dataset(object):
         print(f'dataset_root: {opt.train_data}\nopt.select_data: {opt.select_data}\nopt.batch_ratio: {opt.batch_ratio}')
         log.write(f'dataset_root: {opt.train_data}\nopt.select_data: {opt.select_data}\nopt.batch_ratio: {opt.batch_ratio}\n')
         assert len(opt.select_data) == len(opt.batch_ratio)
-
-        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, augment=opt.augment)
+        assert not (opt.single_loader and opt.bucket_sampler), '--bucket_sampler works with per-source DataLoaders'
+        assert not (opt.stream_shards and (opt.single_loader or opt.bucket_sampler)), \
+            '--stream_shards works with per-source DataLoaders and without --bucket_sampler'
+        # ocrodeg_augment distorts and adds noise to 2d grayscale arrays only
+        assert not (opt.rgb and opt.augment and opt.augment_mode == 'full'), \
+            '--augment_mode full works on grayscale images, use --augment_mode simple or --batch_augment with --rgb'
+
+        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, augment=opt.augment,
+                                     uint8_transport=opt.uint8_transport, resize_backend=opt.resize_backend,
+                                     dynamic_size=opt.dynamic_size, page_orient=opt.page_orient,
+                                     augment_mode=opt.augment_mode, texture_bank=opt.texture_bank,
+                                     batch_augment_ops=opt.batch_augment_ops if opt.batch_augment == 'worker' else None,
+                                     converter=converter, batch_max_length=opt.batch_max_length)
         self.data_loader_list = []
         self.dataloader_iter_list = []
         batch_size_list = []
         Total_batch_size = 0
+        source_dataset_list = []
+        source_batch_size_list = []
+        loader_formats = set()
         for selected_d, batch_ratio_d in zip(opt.select_data, opt.batch_ratio):
             _batch_size = max(round(opt.batch_size * float(batch_ratio_d)), 1)
             print(dashed_line)
             log.write(dashed_line + '\n')
-            _dataset, _dataset_log = hierarchical_dataset(root=opt.train_data, opt=opt, select_data=[selected_d])
+
+            if opt.stream_shards:
+                # sequential shard streaming, total_data_usage_ratio and random access samplers do not apply
+                _dataset, _dataset_log = stream_dataset(root=opt.train_data, opt=opt, select_data=[selected_d])
+                log.write(_dataset_log)
+                selected_d_log = f'num samples of {selected_d} per batch: {opt.batch_size} x {float(batch_ratio_d)} (batch_ratio) = {_batch_size}'
+                print(selected_d_log)
+                log.write(selected_d_log + '\n')
+                batch_size_list.append(str(_batch_size))
+                Total_batch_size += _batch_size
+
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset, batch_size=_batch_size,
+                    num_workers=int(opt.workers),
+                    collate_fn=_AlignCollate, pin_memory=True)
+                self.data_loader_list.append(_data_loader)
+                self.dataloader_iter_list.append(iter(_data_loader))
+                continue
+
+            _dataset, _dataset_log = hierarchical_dataset(root=opt.train_data, opt=opt, select_data=[selected_d],
+                                                          label_index=opt.label_index)
+            # the shards hold images already resized and padded, ocrodeg expects the original image
+            assert not (opt.augment and any(isinstance(d, NpyShardDataset) for d in _dataset.datasets)), \
+                f'--augment does not work with the npy shards of {selected_d}, use --batch_augment instead'
+            loader_formats |= {isinstance(d, NpyShardDataset) for d in _dataset.datasets}
             total_number_dataset = len(_dataset)
             log.write(_dataset_log)
 
@@ -86,17 +141,46 @@ class Batch_Balanced_Dataset(object):
             batch_size_list.append(str(_batch_size))
             Total_batch_size += _batch_size
 
+            if opt.single_loader:
+                source_dataset_list.append(_dataset)
+                source_batch_size_list.append(_batch_size)
+                continue
+
+            if opt.bucket_sampler:
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset,
+                    batch_sampler=BucketBatchSampler(get_dataset_meta(_dataset), _batch_size),
+                    num_workers=int(opt.workers),
+                    collate_fn=_AlignCollate, pin_memory=True,
+                    worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
+            else:
+                _data_loader = torch.utils.data.DataLoader(
+                    _dataset, batch_size=_batch_size,
+                    shuffle=True,
+                    num_workers=int(opt.workers),
+                    collate_fn=_AlignCollate, pin_memory=True,
+                    worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
+            self.data_loader_list.append(_data_loader)
+            self.dataloader_iter_list.append(iter(_data_loader))
+
+        if opt.single_loader:
+            # one DataLoader, so one AlignCollate path for all sources
+            assert len(loader_formats) <= 1, '--single_loader needs all select_data to be npy shards or all lmdb'
             _data_loader = torch.utils.data.DataLoader(
-                _dataset, batch_size=_batch_size,
-                shuffle=True,
+                BatchConcatDataset(source_dataset_list),
+                batch_sampler=BalancedBatchSampler([len(d) for d in source_dataset_list], source_batch_size_list),
                 num_workers=int(opt.workers),
-                collate_fn=_AlignCollate, pin_memory=True)
+                collate_fn=_AlignCollate, pin_memory=True,
+                worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
             self.data_loader_list.append(_data_loader)
             self.dataloader_iter_list.append(iter(_data_loader))
 
         Total_batch_size_log = f'{dashed_line}\n'
         batch_size_sum = '+'.join(batch_size_list)
-        Total_batch_size_log += f'Total_batch_size: {batch_size_sum} = {Total_batch_size}\n'
+        Total_batch_size_log += f'Total_batch_size: {batch_size_sum} = {Total_batch_size}'
+        if opt.bucket_sampler:
+            Total_batch_size_log += ' (at most, smaller for the buckets of long labels)'
+        Total_batch_size_log += '\n'
         Total_batch_size_log += f'{dashed_line}'
         opt.batch_size = Total_batch_size
 
@@ -107,27 +191,226 @@ class Batch_Balanced_Dataset(object):
     def get_batch(self):
         balanced_batch_images = []
         balanced_batch_texts = []
+        balanced_batch_encoded = []
 
         for i, data_loader_iter in enumerate(self.dataloader_iter_list):
             try:
-                image, text = data_loader_iter.next()
+                image, text, *encoded = data_loader_iter.next()
                 balanced_batch_images.append(image)
                 balanced_batch_texts += text
+                balanced_batch_encoded.append(encoded)
             except StopIteration:
                 self.dataloader_iter_list[i] = iter(self.data_loader_list[i])
-                image, text = self.dataloader_iter_list[i].next()
+                image, text, *encoded = self.dataloader_iter_list[i].next()
                 balanced_batch_images.append(image)
                 balanced_batch_texts += text
+                balanced_batch_encoded.append(encoded)
             except ValueError:
                 pass
 
-        balanced_batch_images = torch.cat(balanced_batch_images, 0)
+        if len(balanced_batch_images) == 1:  # single_loader, the batch is already mixed
+            balanced_batch_images = balanced_batch_images[0]
+        else:
+            balanced_batch_images = cat_batches(balanced_batch_images)
 
+        if balanced_batch_encoded and balanced_batch_encoded[0]:  # encoded by the collate, same width for all loaders
+            text = torch.cat([encoded[0] for encoded in balanced_batch_encoded], 0)
+            length = torch.cat([encoded[1] for encoded in balanced_batch_encoded], 0)
+            return balanced_batch_images, balanced_batch_texts, text, length
         return balanced_batch_images, balanced_batch_texts
 
 
-def hierarchical_dataset(root, opt, select_data='/'):
-    """ select_data='/' contains all sub-directory of root directory """
+class BatchPrefetcher(object):
+    """
+    Assemble the next batches of Batch_Balanced_Dataset in a background thread while the current step trains.
+    Each queued item is (image, text, length, labels) with the image already moved to device and the labels
+    already encoded by the converter.
+    """
+
+    def __init__(self, dataset, converter, batch_max_length, device, num_prefetch=2):
+        self.dataset = dataset
+        self.converter = converter
+        self.batch_max_length = batch_max_length
+        self.device = device
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _prefetch(self):
+        try:
+            while True:
+                batch = self.dataset.get_batch()
+                image_tensors, labels = batch[:2]
+                image = normalize_batch(image_tensors, self.device)
+                if len(batch) == 4:  # encoded in the DataLoader workers
+                    text, length = batch[2].to(self.device), batch[3].to(self.device)
+                else:
+                    text, length = self.converter.encode(labels, batch_max_length=self.batch_max_length)
+                self.queue.put((image, text, length, labels))
+        except Exception as e:  # re-raised in the training thread
+            self.queue.put(e)
+
+    def get_batch(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class ValidationCache(object):
+    """
+    The validation set preprocessed once: every batch of loader is kept as a Uint8Batch (4x smaller than the
+    float batch, normalize_batch gives back the same values) with its labels already encoded by the converter,
+    either in RAM or, with mmap_path, in a memory-mapped file written batch by batch.
+    Iterating yields (Uint8Batch, labels, text, length) in a new random batch order each time.
+    """
+
+    def __init__(self, loader, converter, batch_max_length, mmap_path=None):
+        self.batches = []
+        self.mmap_path = mmap_path
+        offsets = []
+        fp = open(mmap_path, 'wb') if mmap_path is not None else None
+        offset = 0
+        for image_tensors, labels in loader:
+            if not isinstance(image_tensors, Uint8Batch):  # exact, the float batch is (x / 255 - 0.5) / 0.5
+                images = image_tensors.mul(0.5).add_(0.5).mul_(255).round_().to(torch.uint8)
+                sizes = torch.LongTensor([list(images.shape[2:])]).repeat(images.size(0), 1)
+                image_tensors = Uint8Batch(images, sizes)
+            text, length = converter.encode(labels, batch_max_length=batch_max_length)
+            if fp is not None:
+                images = image_tensors.images.contiguous().numpy()
+                fp.write(images.tobytes())
+                offsets.append((offset, images.shape))
+                offset += images.nbytes
+                image_tensors = Uint8Batch(None, image_tensors.sizes)
+            self.batches.append((image_tensors, labels, text.cpu(), length.cpu()))
+
+        if fp is not None:
+            fp.close()
+            # copy-on-write, so torch gets writable arrays while the pages stay backed by the file
+            data = np.memmap(mmap_path, dtype=np.uint8, mode='c') if offset > 0 else np.zeros(0, dtype=np.uint8)
+            for i, (start, shape) in enumerate(offsets):
+                images = torch.from_numpy(data[start:start + int(np.prod(shape))].reshape(shape))
+                image_tensors, labels, text, length = self.batches[i]
+                self.batches[i] = (Uint8Batch(images, image_tensors.sizes), labels, text, length)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for i in torch.randperm(len(self.batches)).tolist():
+            yield self.batches[i]
+
+
+def build_validation_cache(loader, converter, opt, mmap_path=None):
+    """
+    ValidationCache of loader, or None when its estimated size exceeds opt.valid_cache_max_mb,
+    then the validation keeps streaming from the loader.
+    """
+    input_channel = 3 if opt.rgb else 1
+    estimated_mb = len(loader.dataset) * input_channel * opt.imgH * (opt.imgW + 3) / 2 ** 20
+    if estimated_mb > opt.valid_cache_max_mb:
+        print(f'validation cache needs about {estimated_mb:0.1f} MB > valid_cache_max_mb {opt.valid_cache_max_mb}, '
+              f'validate from the dataset instead')
+        return None
+    start_time = time.time()
+    cache = ValidationCache(loader, converter, opt.batch_max_length, mmap_path)
+    print(f'cached {len(cache)} validation batches ({estimated_mb:0.1f} MB at most) '
+          f'in {"RAM" if mmap_path is None else mmap_path}, {time.time() - start_time:0.1f} s')
+    return cache
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler which groups samples of similar label length and aspect ratio (height / width),
+    using the metadata of get_dataset_meta instead of decoding the images.
+    Label lengths are bucketed by length_step characters and aspect ratios by half octaves. The batch size of
+    each bucket keeps the number of label tokens per batch close to batch_size x (mean label length),
+    bounded by [1, max_batch_size]. max_batch_size defaults to batch_size, so the batches of a source never
+    exceed its share of batch_ratio, the buckets of long labels make smaller ones.
+    Batches are shuffled within and across buckets every epoch.
+    """
+
+    def __init__(self, sample_meta, batch_size, length_step=4, max_batch_size=None, drop_last=False):
+        sample_meta = np.asarray(sample_meta)
+        label_length = np.maximum(sample_meta[:, 0], 1)
+        width = np.maximum(sample_meta[:, 1], 1)
+        height = np.maximum(sample_meta[:, 2], 1)
+        length_bin = (label_length - 1) // length_step
+        ratio_bin = np.floor(np.log2(height / width) * 2).astype(np.int64)
+
+        max_batch_size = max_batch_size or batch_size
+        tokens_per_batch = batch_size * label_length.mean() if len(label_length) > 0 else batch_size
+        self.bucket_list = []
+        self.bucket_batch_size_list = []
+        keys = np.stack([length_bin, ratio_bin], axis=1)
+        if len(keys) > 0:
+            _, bucket_ids = np.unique(keys, axis=0, return_inverse=True)
+            for bucket_id in range(bucket_ids.max() + 1):
+                bucket = np.nonzero(bucket_ids.reshape(-1) == bucket_id)[0]
+                bucket_max_length = (length_bin[bucket[0]] + 1) * length_step
+                bucket_batch_size = int(np.clip(round(tokens_per_batch / bucket_max_length), 1, max_batch_size))
+                self.bucket_list.append(bucket)
+                self.bucket_batch_size_list.append(bucket_batch_size)
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // bs for b, bs in zip(self.bucket_list, self.bucket_batch_size_list))
+        return sum((len(b) + bs - 1) // bs for b, bs in zip(self.bucket_list, self.bucket_batch_size_list))
+
+    def __iter__(self):
+        batch_list = []
+        for bucket, bucket_batch_size in zip(self.bucket_list, self.bucket_batch_size_list):
+            bucket = bucket[torch.randperm(len(bucket)).numpy()]
+            for start in range(0, len(bucket), bucket_batch_size):
+                batch = bucket[start:start + bucket_batch_size]
+                if self.drop_last and len(batch) < bucket_batch_size:
+                    continue
+                batch_list.append(batch.tolist())
+        for i in torch.randperm(len(batch_list)).tolist():
+            yield batch_list[i]
+
+
+class BalancedBatchSampler(Sampler):
+    """
+    Batch sampler over the concatenation of several sources, used by Batch_Balanced_Dataset with --single_loader.
+    Every batch holds exactly batch_size_list[i] samples of source i. Each source is drawn from its own
+    random permutation, which is reshuffled when exhausted; one epoch ends when the largest source is exhausted.
+    """
+
+    def __init__(self, dataset_size_list, batch_size_list):
+        assert len(dataset_size_list) == len(batch_size_list)
+        self.dataset_size_list = dataset_size_list
+        self.batch_size_list = batch_size_list
+        self.offset_list = [0] + list(_accumulate(dataset_size_list))[:-1]
+
+    def __len__(self):
+        return max([size // batch_size for size, batch_size in zip(self.dataset_size_list, self.batch_size_list)] + [1])
+
+    def __iter__(self):
+        permutation_list = [torch.randperm(size).tolist() for size in self.dataset_size_list]
+        position_list = [0] * len(self.dataset_size_list)
+        for _ in range(len(self)):
+            batch = []
+            for i, (size, batch_size, offset) in enumerate(
+                    zip(self.dataset_size_list, self.batch_size_list, self.offset_list)):
+                if size == 0:
+                    continue
+                for _ in range(batch_size):
+                    if position_list[i] == size:
+                        permutation_list[i] = torch.randperm(size).tolist()
+                        position_list[i] = 0
+                    batch.append(offset + permutation_list[i][position_list[i]])
+                    position_list[i] += 1
+            yield batch
+
+
+def hierarchical_dataset(root, opt, select_data='/', label_index=False):
+    """
+    select_data='/' contains all sub-directory of root directory.
+    label_index: the datasets return their labels as charset positions, see LmdbDataset.
+    """
     dataset_list = []
     dataset_log = f'dataset_root:    {root}\t dataset: {select_data[0]}'
     print(dataset_log)
@@ -141,117 +424,399 @@ def hierarchical_dataset(root, opt, select_data='/'):
                     break
 
             if select_flag:
-                dataset = LmdbDataset(dirpath, opt)
+                if os.path.isfile(os.path.join(dirpath, SHARD_META_FILE)):
+                    dataset = NpyShardDataset(dirpath, opt, label_index)
+                else:
+                    dataset = LmdbDataset(dirpath, opt, label_index)
                 sub_dataset_log = f'sub-directory:\t/{os.path.relpath(dirpath, root)}\t num samples: {len(dataset)}'
                 print(sub_dataset_log)
                 dataset_log += f'{sub_dataset_log}\n'
                 dataset_list.append(dataset)
 
-    concatenated_dataset = ConcatDataset(dataset_list)
+    # AlignCollate picks the npy shard or the PIL image path of a batch from its first sample
+    assert len({isinstance(d, NpyShardDataset) for d in dataset_list}) <= 1, \
+        f'{root} {select_data} selects both npy shard and lmdb directories, select them separately'
+    concatenated_dataset = BatchConcatDataset(dataset_list)
 
     return concatenated_dataset, dataset_log
 
 
-class LmdbDataset(Dataset):
+class BatchConcatDataset(ConcatDataset):
+    """ ConcatDataset which forwards a batch of indices to the __getitems__ of the sub-datasets """
+
+    def __getitems__(self, indices):
+        groups = defaultdict(list)
+        for position, index in enumerate(indices):
+            if index < 0:
+                index += len(self)
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, index)
+            sample_idx = index if dataset_idx == 0 else index - self.cumulative_sizes[dataset_idx - 1]
+            groups[dataset_idx].append((position, sample_idx))
+
+        samples = [None] * len(indices)
+        for dataset_idx, group in groups.items():
+            dataset = self.datasets[dataset_idx]
+            sample_indices = [sample_idx for _, sample_idx in group]
+            if hasattr(dataset, '__getitems__'):
+                fetched = dataset.__getitems__(sample_indices)
+            else:
+                fetched = [dataset[sample_idx] for sample_idx in sample_indices]
+            for (position, _), sample in zip(group, fetched):
+                samples[position] = sample
+        return samples
+
+
+def lmdb_fingerprint(root, nSamples, data_file='data.mdb'):
+    """ identify the content of a lmdb (or shard set) by its sample count and the size / mtime of its data file """
+    stat = os.stat(os.path.join(root, data_file))
+    return f'{nSamples}-{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def filtered_index_key(root, nSamples, opt, data_file='data.mdb'):
+    """ the filtered index only depends on the lmdb, the charset, batch_max_length and sensitive """
+    charset_hash = get_charset(opt.character).hash
+    key = f'{lmdb_fingerprint(root, nSamples, data_file)}|{charset_hash}|{opt.batch_max_length}|{opt.sensitive}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def load_filtered_index(root, nSamples, opt, get_label, data_file='data.mdb'):
+    """
+    Load the sorted (1-based) indices of the samples which survive label filtering.
+    The indices are cached next to the lmdb as a int32 .npy file and memory-mapped read-only,
+    so the DataLoader workers share the same pages instead of each holding a list of python ints.
+    The cache is rebuilt only when the lmdb, the charset, batch_max_length or sensitive changes.
+    """
+    cache_path = os.path.join(root, f'filtered_index_{filtered_index_key(root, nSamples, opt, data_file)}.npy')
+    return load_or_build_npy(cache_path, lambda: build_filtered_index(nSamples, opt, get_label))
+
+
+def load_or_build_npy(cache_path, build):
+    """ memory-map the .npy sidecar at cache_path, building and writing it first if it does not exist """
+    if os.path.isfile(cache_path):
+        return np.load(cache_path, mmap_mode='r')
+
+    array = build()
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            np.save(fp, array)
+        os.replace(tmp_path, cache_path)  # atomic, several processes may build the same cache
+    except OSError as e:
+        print(f'cannot write cache {cache_path}: {e}')
+        return array
+    return np.load(cache_path, mmap_mode='r')
+
+
+def build_filtered_index(nSamples, opt, get_label):
+    """ Filtering part
+    If you want to evaluate IC15-2077 & CUTE datasets which have special character labels, use --data_filtering_off and only evaluate on alphabets and digits.
+    And if you want to evaluate them with the model trained with --sensitive option, use --sensitive and --data_filtering_off,
+    """
+    # By default, images containing characters which are not in opt.character are filtered.
+    # You can add [UNK] token to `opt.character` in utils.py instead of this filtering.
+    charset = get_charset(opt.character)
+    filtered_index_list = []
+    for index in range(nSamples):
+        index += 1  # lmdb starts with 1
+        label = get_label(index)
+        if len(label) > opt.batch_max_length:
+            continue
+        if not charset.is_valid(label):
+            continue
+        filtered_index_list.append(index)
+    return np.array(filtered_index_list, dtype=np.int32)
+
+
+def label_index_key(root, nSamples, opt, data_file='data.mdb'):
+    """ the encoded labels only depend on the lmdb, the charset and sensitive """
+    key = f'{lmdb_fingerprint(root, nSamples, data_file)}|{get_charset(opt.character).hash}|{opt.sensitive}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def load_label_index(root, nSamples, opt, get_label, data_file='data.mdb'):
+    """
+    Load the labels of all samples encoded as positions in opt.character: one packed int32 array of all the
+    filtered labels, and int64 offsets [nSamples + 1], the label of the 1-based index being
+    values[offsets[index - 1]:offsets[index]]. They are memory-mapped from .npy sidecars next to the lmdb,
+    keyed by the charset hash, so runs with different charsets share the lmdb. create_label_index.py
+    builds them offline, otherwise they are built on first use.
+    """
+    key = label_index_key(root, nSamples, opt, data_file)
+    built = []
+
+    def build():
+        if not built:
+            built.extend(build_label_index(nSamples, opt, get_label))
+        return built
+
+    values = load_or_build_npy(os.path.join(root, f'label_index_{key}.npy'), lambda: build()[0])
+    offsets = load_or_build_npy(os.path.join(root, f'label_offsets_{key}.npy'), lambda: build()[1])
+    return values, offsets
+
+
+def build_label_index(nSamples, opt, get_label):
+    """ the filtered (and, without sensitive, lowercased) labels of an lmdb, encoded in one lookup """
+    charset = get_charset(opt.character)
+    labels = [charset.filter(get_label(index), opt.sensitive) for index in range(1, nSamples + 1)]
+    offsets = np.zeros(nSamples + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(label) for label in labels])
+    return charset.lookup(charset.codepoints(''.join(labels))), offsets
+
+
+def open_lmdb(root):
+    env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+    if not env:
+        print('cannot create lmdb from %s' % (root))
+        sys.exit(0)
+    return env
+
+
+def iter_leaf_datasets(dataset):
+    """ yield the datasets wrapped by (nested) ConcatDataset / Subset """
+    if isinstance(dataset, ConcatDataset):
+        for d in dataset.datasets:
+            yield from iter_leaf_datasets(d)
+    elif isinstance(dataset, Subset):
+        yield from iter_leaf_datasets(dataset.dataset)
+    else:
+        yield dataset
+
+
+def get_dataset_meta(dataset):
+    """ (label length, width, height) of every sample of a (nested) ConcatDataset / Subset of leaf datasets """
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([get_dataset_meta(d) for d in dataset.datasets], axis=0)
+    elif isinstance(dataset, Subset):
+        return get_dataset_meta(dataset.dataset)[np.asarray(dataset.indices)]
+    else:
+        return np.asarray(dataset.get_sample_meta())
+
+
+def lmdb_worker_init_fn(worker_id):
+    """ worker_init_fn for --lazy_lmdb, each DataLoader worker opens its own lmdb environments """
+    dataset = torch.utils.data.get_worker_info().dataset
+    for d in iter_leaf_datasets(dataset):
+        if hasattr(d, 'open_lmdb'):
+            d.open_lmdb()
+
+
+# lmdb datasets written by create_augmented_lmdb.py keep the original layout and add
+# 'num-variants' pre-rendered augmented images of every sample under 'image-%09d-%03d'
+NUM_VARIANTS_KEY = 'num-variants'.encode()
+
+
+def variantKey(index, variant):
+    return 'image-%09d-%03d'.encode() % (index, variant)
+
+
+class LazyLmdbMixin(object):
+    """
+    With lazy=True the environment opened in __init__ is closed again, so no lmdb handle is forked
+    into the DataLoader workers. Each process then opens its own environment on first use
+    (or in lmdb_worker_init_fn) and keeps one long-lived read-only transaction for all reads,
+    instead of calling env.begin() for every sample.
+    With num_variants > 0 every read returns one of the pre-rendered variants of the image, chosen at random.
+    """
+    num_variants = 0
+
+    def open_lmdb(self):
+        self.env = open_lmdb(self.root)
+        self.txn = self.env.begin(write=False)
+        self.env_pid = os.getpid()
+
+    def close_lmdb(self):
+        if self.txn is not None:
+            self.txn.abort()
+        if self.env is not None:
+            self.env.close()
+        self.env, self.txn, self.env_pid = None, None, None
+
+    def read_buffers(self, index):
+        """ return the raw (label, image) buffers of the 1-based lmdb index """
+        label_key = 'label-%09d'.encode() % index
+        img_key = self.image_key(index)
+        if self.lazy:
+            if self.env_pid != os.getpid():
+                self.open_lmdb()
+            return self.txn.get(label_key), self.txn.get(img_key)
+        with self.env.begin(write=False) as txn:
+            return txn.get(label_key), txn.get(img_key)
 
-    def __init__(self, root, opt):
+    def read_buffers_batch(self, indices):
+        """
+        return the raw (label, image) buffers of many 1-based lmdb indices.
+        All keys are fetched in sorted order through one cursor, so a batch costs one walk over
+        the B-tree instead of two random lookups per sample.
+        """
+        label_keys = ['label-%09d'.encode() % index for index in indices]
+        img_keys = [self.image_key(index) for index in indices]
+        keys = sorted(label_keys + img_keys)
+        if self.lazy:
+            if self.env_pid != os.getpid():
+                self.open_lmdb()
+            values = self._get_sorted(self.txn, keys)
+        else:
+            with self.env.begin(write=False) as txn:
+                values = self._get_sorted(txn, keys)
+        return [(values.get(label_key), values.get(img_key)) for label_key, img_key in zip(label_keys, img_keys)]
+
+    def image_key(self, index):
+        if self.num_variants:
+            return variantKey(index, random.randrange(self.num_variants))
+        return 'image-%09d'.encode() % index
+
+    @staticmethod
+    def _get_sorted(txn, keys):
+        with txn.cursor() as cursor:
+            if hasattr(cursor, 'getmulti'):  # lmdb >= 1.1
+                return dict(cursor.getmulti(keys))
+            values = {}
+            for key in keys:
+                if cursor.set_key(key):
+                    values[key] = cursor.value()
+            return values
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.lazy:
+            state['env'], state['txn'], state['env_pid'] = None, None, None
+        return state
+
+
+class LmdbDataset(LazyLmdbMixin, Dataset):
+    """
+    label_index: return the labels as int32 arrays of positions in opt.character, read from the sidecar of
+    load_label_index, instead of decoding and filtering the label strings. The converters encode both.
+    """
+
+    def __init__(self, root, opt, label_index=False):
 
         self.root = root
         self.opt = opt
-        self.env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
-        if not self.env:
-            print('cannot create lmdb from %s' % (root))
-            sys.exit(0)
+        self.lazy = opt.lazy_lmdb
+        self.env = open_lmdb(root)
+        self.txn = None
+        self.env_pid = os.getpid()
 
         with self.env.begin(write=False) as txn:
             nSamples = int(txn.get('num-samples'.encode()))
-            self.nSamples = nSamples
+            if self.opt.use_variants:
+                self.num_variants = int(txn.get(NUM_VARIANTS_KEY) or 0)
 
             if self.opt.data_filtering_off:
                 # for fast check or benchmark evaluation with no filtering
-                self.filtered_index_list = [index + 1 for index in range(self.nSamples)]
+                self.filtered_index_list = np.arange(1, nSamples + 1, dtype=np.int32)
             else:
-                """ Filtering part
-                If you want to evaluate IC15-2077 & CUTE datasets which have special character labels, use --data_filtering_off and only evaluate on alphabets and digits.
-                And if you want to evaluate them with the model trained with --sensitive option, use --sensitive and --data_filtering_off,
-                """
-                self.filtered_index_list = []
-                for index in range(self.nSamples):
-                    index += 1  # lmdb starts with 1
-                    label_key = 'label-%09d'.encode() % index
-                    label = txn.get(label_key).decode('utf-8')
-
-                    if len(label) > self.opt.batch_max_length:
-                        # print(f'The length of the label is longer than max_length: length
-                        # {len(label)}, {label} in dataset {self.root}')
-                        continue
+                self.filtered_index_list = load_filtered_index(
+                    root, nSamples, opt, lambda index: txn.get('label-%09d'.encode() % index).decode('utf-8'))
 
-                    # By default, images containing characters which are not in opt.character are filtered.
-                    # You can add [UNK] token to `opt.character` in utils.py instead of this filtering.
-                    out_of_char = f'[^{self.opt.character}]'
-                    if re.search(out_of_char, label.lower()):
-                        continue
+            self.nSamples = len(self.filtered_index_list)
 
-                    self.filtered_index_list.append(index)
+            self.label_index = None
+            if label_index:
+                self.label_index = load_label_index(
+                    root, nSamples, opt, lambda index: txn.get('label-%09d'.encode() % index).decode('utf-8'))
 
-                self.nSamples = len(self.filtered_index_list)
+        if self.lazy:
+            self.close_lmdb()
+
+        # We only train and evaluate on alphanumerics (or pre-defined character set in train.py)
+        self.charset = get_charset(self.opt.character)
 
     def __len__(self):
         return self.nSamples
 
     def __getitem__(self, index):
         assert index <= len(self), 'index range error'
-        index = self.filtered_index_list[index]
+        index = int(self.filtered_index_list[index])
+
+        labelbuf, imgbuf = self.read_buffers(index)
+        return self.decode_sample(index, labelbuf, imgbuf)
 
+    def __getitems__(self, indices):
+        """ batch fetch used by DataLoader (torch >= 2.0): one lmdb pass, then decode in a loop """
+        indices = [int(self.filtered_index_list[index]) for index in indices]
+        return [self.decode_sample(index, labelbuf, imgbuf)
+                for index, (labelbuf, imgbuf) in zip(indices, self.read_buffers_batch(indices))]
+
+    def get_sample_meta(self):
+        """
+        [len(self), 3] int32 array of (label length, image width, image height) of the filtered samples,
+        read from the lmdb metadata records (or the image headers) without decoding,
+        and cached next to the lmdb like the filtered index.
+        """
+        key = filtered_index_key(self.root, self.nSamples, self.opt)
+        suffix = '_all' if self.opt.data_filtering_off else ''
+        cache_path = os.path.join(self.root, f'sample_meta_{key}{suffix}.npy')
+        return load_or_build_npy(cache_path, self._build_sample_meta)
+
+    def _build_sample_meta(self):
+        meta = np.zeros((self.nSamples, 3), dtype=np.int32)
+        if self.env_pid != os.getpid():
+            self.open_lmdb()
         with self.env.begin(write=False) as txn:
-            label_key = 'label-%09d'.encode() % index
-            label = txn.get(label_key).decode('utf-8')
-            img_key = 'image-%09d'.encode() % index
-            imgbuf = txn.get(img_key)
-
-            buf = six.BytesIO()
-            buf.write(imgbuf)
-            buf.seek(0)
-            try:
-                if self.opt.rgb:
-                    img = Image.open(buf).convert('RGB')  # for color image
+            use_lmdb_meta = has_meta(txn)  # written at build time or by lmdb_meta.py
+            for position, index in enumerate(self.filtered_index_list):
+                index = int(index)
+                if use_lmdb_meta:
+                    width, height, _, label_length, _, _ = unpack_meta(txn.get(metaKey(index)))
                 else:
-                    img = Image.open(buf).convert('L')
+                    label_length = len(txn.get('label-%09d'.encode() % index).decode('utf-8'))
+                    try:
+                        # only parses the header
+                        width, height = Image.open(six.BytesIO(txn.get('image-%09d'.encode() % index))).size
+                    except IOError:
+                        width, height = 0, 0
+                meta[position] = (label_length, width, height)
+        if self.lazy:  # do not fork the environment into the DataLoader workers
+            self.close_lmdb()
+        return meta
+
+    def decode_sample(self, index, labelbuf, imgbuf):
+        label = None
 
-            except IOError:
-                print(f'Corrupted image for {index}')
-                # make dummy image and dummy label for corrupted image.
-                if self.opt.rgb:
-                    img = Image.new('RGB', (self.opt.imgW, self.opt.imgH))
-                else:
-                    img = Image.new('L', (self.opt.imgW, self.opt.imgH))
-                label = '[dummy_label]'
+        try:
+            img = decode_image(imgbuf, self.opt.rgb, (self.opt.imgW, self.opt.imgH), self.opt.decoder)
+        except IOError:
+            print(f'Corrupted image for {index}')
+            # make dummy image and dummy label for corrupted image.
+            if self.opt.rgb:
+                img = Image.new('RGB', (self.opt.imgW, self.opt.imgH))
+            else:
+                img = Image.new('L', (self.opt.imgW, self.opt.imgH))
+            label = '[dummy_label]'
 
-            if not self.opt.sensitive:
-                label = label.lower()
+        if self.label_index is not None and label is None:
+            values, offsets = self.label_index
+            return img, np.array(values[offsets[index - 1]:offsets[index]])
 
-            # We only train and evaluate on alphanumerics (or pre-defined character set in train.py)
-            out_of_char = f'[^{self.opt.character}]'
-            label = re.sub(out_of_char, '', label)
+        if label is None:
+            label = labelbuf.decode('utf-8')
+        label = self.charset.filter(label, self.opt.sensitive)
 
+        if self.label_index is not None:  # the dummy label of a corrupted image
+            return img, self.charset.lookup(self.charset.codepoints(label))
         return img, label
 
 
-class LmdbDataset_2(Dataset):
+class LmdbDataset_2(LazyLmdbMixin, Dataset):
 
-    def __init__(self, root):
+    def __init__(self, root, lazy=False):
 
         self.root = root
-        self.env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
-        if not self.env:
-            print('cannot create lmdb from %s' % (root))
-            sys.exit(0)
+        self.lazy = lazy
+        self.env = open_lmdb(root)
+        self.txn = None
+        self.env_pid = os.getpid()
 
         with self.env.begin(write=False) as txn:
             nSamples = int(txn.get('num-samples'.encode()))
             self.nSamples = nSamples
             self.filtered_index_list = [index + 1 for index in range(self.nSamples)]
 
+        if self.lazy:
+            self.close_lmdb()
+
     def __len__(self):
         return self.nSamples
 
@@ -259,28 +824,196 @@ class LmdbDataset_2(Dataset):
         assert index <= len(self), 'index range error'
         index = self.filtered_index_list[index]
 
-        with self.env.begin(write=False) as txn:
-            label_key = 'label-%09d'.encode() % index
-            label = txn.get(label_key).decode('utf-8')
-            img_key = 'image-%09d'.encode() % index
-            imgbuf = txn.get(img_key)
-
-            buf = six.BytesIO()
-            buf.write(imgbuf)
-            buf.seek(0)
-            try:
-                img = Image.open(buf).convert('L')
-            except IOError:
-                print(f'Corrupted image for {index}')
-                # make dummy image and dummy label for corrupted image.
+        labelbuf, imgbuf = self.read_buffers(index)
+        return self.decode_sample(index, labelbuf, imgbuf)
 
-                img = Image.new('L', (32, 100))
-                label = '[dummy_label]'
+    def __getitems__(self, indices):
+        indices = [self.filtered_index_list[index] for index in indices]
+        return [self.decode_sample(index, labelbuf, imgbuf)
+                for index, (labelbuf, imgbuf) in zip(indices, self.read_buffers_batch(indices))]
+
+    def decode_sample(self, index, labelbuf, imgbuf):
+        label = labelbuf.decode('utf-8')
+
+        buf = six.BytesIO()
+        buf.write(imgbuf)
+        buf.seek(0)
+        try:
+            img = Image.open(buf).convert('L')
+        except IOError:
+            print(f'Corrupted image for {index}')
+            # make dummy image and dummy label for corrupted image.
+
+            img = Image.new('L', (32, 100))
+            label = '[dummy_label]'
 
         return img, label
 
 
 
+SHARD_META_FILE = 'shard_meta.json'
+
+
+class NpyShardDataset(Dataset):
+    """
+    Dataset of images which are already decoded and resized to a fixed imgH x imgW (and PAD) setting,
+    stored as memory-mapped uint8 .npy shards [N, C, imgH, imgW] by create_npy_shards.py.
+    __getitem__ returns a uint8 tensor, AlignCollate then only normalizes it.
+    label_index: return the labels as int32 arrays of positions in opt.character, like LmdbDataset.
+    """
+
+    def __init__(self, root, opt, label_index=False):
+        self.root = root
+        self.opt = opt
+        with open(os.path.join(root, SHARD_META_FILE), 'r', encoding='utf-8') as fp:
+            meta = json.load(fp)
+        for key in ['imgH', 'imgW', 'PAD', 'rgb']:
+            if meta[key] != getattr(opt, key):
+                raise ValueError(f'shards in {root} are built with {key}={meta[key]}, but opt.{key}={getattr(opt, key)}')
+
+        self.shard_size = meta['shard_size']
+        self.shards = [np.load(os.path.join(root, 'images_%05d.npy' % i), mmap_mode='r')
+                       for i in range(meta['num_shards'])]
+        self.label_bytes = np.memmap(os.path.join(root, 'labels.bin'), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(root, 'labels.bin')) > 0 else np.zeros(0, dtype=np.uint8)
+        self.label_offsets = np.load(os.path.join(root, 'label_offsets.npy'), mmap_mode='r')
+        nSamples = meta['num_samples']
+
+        if self.opt.data_filtering_off:
+            self.filtered_index_list = np.arange(1, nSamples + 1, dtype=np.int32)
+        else:
+            self.filtered_index_list = load_filtered_index(root, nSamples, opt, self.get_label,
+                                                           data_file=SHARD_META_FILE)
+        self.nSamples = len(self.filtered_index_list)
+        self.label_index = None
+        if label_index:
+            self.label_index = load_label_index(root, nSamples, opt, self.get_label, data_file=SHARD_META_FILE)
+        self.charset = get_charset(self.opt.character)
+
+    def get_sample_meta(self):
+        """ (label length, width, height) per sample, the images in the shards all have the same size """
+        meta = np.zeros((self.nSamples, 3), dtype=np.int32)
+        meta[:, 0] = [len(self.get_label(int(index))) for index in self.filtered_index_list]
+        meta[:, 1], meta[:, 2] = self.opt.imgW, self.opt.imgH
+        return meta
+
+    def get_label(self, index):
+        """ raw label of the 1-based sample index, same numbering as the source lmdb """
+        start, end = self.label_offsets[index - 1], self.label_offsets[index]
+        return self.label_bytes[start:end].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return self.nSamples
+
+    def __getitem__(self, index):
+        assert index <= len(self), 'index range error'
+        index = int(self.filtered_index_list[index])
+
+        position = index - 1
+        img = torch.from_numpy(np.array(self.shards[position // self.shard_size][position % self.shard_size]))
+        if self.label_index is not None:
+            values, offsets = self.label_index
+            return img, np.array(values[offsets[index - 1]:offsets[index]])
+        label = self.get_label(index)
+
+        label = self.charset.filter(label, self.opt.sensitive)
+
+        return img, label
+
+
+STREAM_META_FILE = 'stream_meta.json'
+STREAM_RECORD_HEADER = struct.Struct('<II')  # label length, image length, followed by label and image bytes
+
+
+def stream_dataset(root, opt, select_data='/'):
+    """ collect the record shards of all selected sub-directories of root into one StreamShardDataset """
+    shard_path_list = []
+    nSamples = 0
+    dataset_log = f'dataset_root:    {root}\t dataset: {select_data[0]}'
+    print(dataset_log)
+    dataset_log += '\n'
+    for dirpath, dirnames, filenames in os.walk(root+'/'):
+        if STREAM_META_FILE in filenames and any(selected_d in dirpath for selected_d in select_data):
+            with open(os.path.join(dirpath, STREAM_META_FILE), 'r', encoding='utf-8') as fp:
+                meta = json.load(fp)
+            shard_path_list += [os.path.join(dirpath, shard) for shard in meta['shards']]
+            nSamples += meta['num_samples']
+            sub_dataset_log = f'sub-directory:\t/{os.path.relpath(dirpath, root)}\t num samples: {meta["num_samples"]}\t num shards: {len(meta["shards"])}'
+            print(sub_dataset_log)
+            dataset_log += f'{sub_dataset_log}\n'
+
+    return StreamShardDataset(shard_path_list, nSamples, opt), dataset_log
+
+
+class StreamShardDataset(IterableDataset):
+    """
+    Iterable dataset over length-prefixed record shards written by create_stream_shards.py.
+    Each DataLoader worker reads its own subset of the shards sequentially with large buffered reads,
+    and yields samples through an in-memory shuffle buffer of opt.shuffle_buffer samples.
+    The shard order is reshuffled every epoch with a seed shared by all workers of that epoch.
+    """
+
+    def __init__(self, shard_path_list, nSamples, opt, read_buffer_size=8 * 1024 * 1024):
+        self.shard_path_list = shard_path_list
+        self.nSamples = nSamples  # before filtering, only used for logging
+        self.opt = opt
+        self.read_buffer_size = read_buffer_size
+        self.charset = get_charset(self.opt.character)
+
+    def __len__(self):
+        return self.nSamples
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, seed = 0, 1, random.getrandbits(32)
+        else:
+            # worker seeds are base_seed + worker id, base_seed is shared by all workers of an epoch
+            worker_id, num_workers, seed = worker_info.id, worker_info.num_workers, worker_info.seed - worker_info.id
+        shard_path_list = list(self.shard_path_list)
+        random.Random(seed).shuffle(shard_path_list)
+        shard_path_list = shard_path_list[worker_id::num_workers]
+        if not shard_path_list:
+            print(f'worker {worker_id} has no shard, use at least as many shards as workers')
+            return
+
+        rng = random.Random(seed + worker_id)
+        shuffle_buffer = []
+        for shard_path in shard_path_list:
+            for sample in self._read_shard(shard_path):
+                if len(shuffle_buffer) < self.opt.shuffle_buffer:
+                    shuffle_buffer.append(sample)
+                    continue
+                i = rng.randrange(len(shuffle_buffer))
+                shuffle_buffer[i], sample = sample, shuffle_buffer[i]
+                yield sample
+        rng.shuffle(shuffle_buffer)
+        yield from shuffle_buffer
+
+    def _read_shard(self, shard_path):
+        with open(shard_path, 'rb', buffering=self.read_buffer_size) as fp:
+            while True:
+                header = fp.read(STREAM_RECORD_HEADER.size)
+                if len(header) < STREAM_RECORD_HEADER.size:
+                    break
+                label_length, image_length = STREAM_RECORD_HEADER.unpack(header)
+                label = fp.read(label_length).decode('utf-8')
+                imgbuf = fp.read(image_length)
+
+                if not self.opt.data_filtering_off:
+                    if len(label) > self.opt.batch_max_length or not self.charset.is_valid(label):
+                        continue
+
+                try:
+                    img = decode_image(imgbuf, self.opt.rgb, (self.opt.imgW, self.opt.imgH), self.opt.decoder)
+                except IOError:
+                    print(f'Corrupted image in {shard_path}')
+                    continue
+
+                label = self.charset.filter(label, self.opt.sensitive)
+                yield img, label
+
+
 class RawDataset(Dataset):
 
     def __init__(self, root, opt):
@@ -302,11 +1035,8 @@ class RawDataset(Dataset):
     def __getitem__(self, index):
 
         try:
-            if self.opt.rgb:
-                img = Image.open(self.image_path_list[index]).convert('RGB')  # for color image
-            else:
-                img = Image.open(self.image_path_list[index]).convert('L')
-
+            with open(self.image_path_list[index], 'rb') as fp:
+                img = decode_image(fp.read(), self.opt.rgb, (self.opt.imgW, self.opt.imgH), self.opt.decoder)
         except IOError:
             print(f'Corrupted image for {index}')
             # make dummy image and dummy label for corrupted image.
@@ -383,7 +1113,7 @@ class FontDataset(Dataset):
         return self.nSamples
 
     def get_valid_char(self, characters):
-        return [ch for ch in characters if ch in self.valid_char_set]
+        return [ch for ch in get_charset(characters).chars if ch in self.valid_char_set]
 
     def __getitem__(self, index):
         if self.opt.rgb:
@@ -449,47 +1179,306 @@ class NormalizePAD_vertical(object):
         return Pad_img
 
 
-class AlignCollate(object):
+# uint8 batch of AlignCollate(uint8_transport=True), images: uint8 [B, C, H, W],
+# sizes: int64 [B, 2], the valid (height, width) of each image. The rest is padded by normalize_batch.
+Uint8Batch = namedtuple('Uint8Batch', ['images', 'sizes'])
+
+
+def normalize_batch(image_tensors, device):
+    """
+    move a collated batch to device and return the float images in [-1, 1].
+    A Uint8Batch is padded by replicating the last valid row / column of each image, then normalized on device.
+    """
+    if not isinstance(image_tensors, Uint8Batch):
+        return image_tensors.to(device, non_blocking=True)
+
+    sizes = image_tensors.sizes
+    images = image_tensors.images.to(device, non_blocking=True)
+    b, c, h, w = images.size()
+    if (sizes[:, 0] != h).any():
+        rows = torch.min(torch.arange(h)[None, :], sizes[:, 0:1] - 1).to(device, non_blocking=True)
+        images = images.gather(2, rows[:, None, :, None].expand(b, c, h, w))
+    if (sizes[:, 1] != w).any():
+        cols = torch.min(torch.arange(w)[None, :], sizes[:, 1:2] - 1).to(device, non_blocking=True)
+        images = images.gather(3, cols[:, None, None, :].expand(b, c, h, w))
+    return images.float().div_(255).sub_(0.5).div_(0.5)
+
+
+def cat_batches(batches):
+    """ concatenate collated batches, after padding them to the same size (they differ with dynamic_size) """
+    images = [b.images if isinstance(b, Uint8Batch) else b for b in batches]
+    height = max(image.size(2) for image in images)
+    width = max(image.size(3) for image in images)
+    for i, image in enumerate(images):
+        pad = (0, width - image.size(3), 0, height - image.size(2))
+        if pad[1] or pad[3]:
+            # uint8 batches are zero padded, normalize_batch replicates the border from their sizes
+            images[i] = F.pad(image, pad, mode='replicate' if image.is_floating_point() else 'constant')
+    if isinstance(batches[0], Uint8Batch):
+        return Uint8Batch(torch.cat(images, 0), torch.cat([b.sizes for b in batches], 0))
+    return torch.cat(images, 0)
+
 
-    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, augment=False):
+class AlignCollate(object):
+    """
+    uint8_transport: return a Uint8Batch instead of float tensors, 4x less data from the DataLoader workers.
+    The consumer pads and normalizes it with normalize_batch.
+    resize_backend: 'pil' resizes one image at a time with Image.resize,
+                    'tensor' resizes the images of similar size together with resize_batch_tensor.
+    dynamic_size: with keep_ratio_with_pad, pad only up to the largest image of the batch rounded up to
+                  size_multiple (the stride of the feature extractors), instead of up to imgH x imgW.
+                  For horizontal page_orient the images keep imgH and the right border is padded,
+                  otherwise they keep imgW and the bottom border is padded as without dynamic_size.
+    augment_mode: 'simple' is ocrodeg_simple_augment (binary blur), 'full' is ocrodeg_augment (distort,
+                  binary blur and print-like noise), which takes its noise from the texture_bank .npy if given.
+    batch_augment_ops: augment the whole padded batch with BatchAugment(batch_augment_ops), see modules/augmentation.py.
+    converter: also encode the labels with converter.encode_batch(labels, batch_max_length),
+               the batch is then (images, labels, text, length).
+    """
+
+    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, augment=False, uint8_transport=False,
+                 resize_backend='pil', dynamic_size=False, page_orient='vertical', size_multiple=4,
+                 augment_mode='simple', texture_bank=None, batch_augment_ops=None, converter=None, batch_max_length=25):
         self.imgH = imgH
         self.imgW = imgW
         self.keep_ratio_with_pad = keep_ratio_with_pad
         self.augment = augment
+        if augment_mode not in ['simple', 'full']:
+            raise ValueError('augment_mode should be simple or full')
+        self.augment_mode = augment_mode
+        self.texture_bank = ocrodeg.TextureBank(texture_bank) if texture_bank else None
+        self.batch_augment = BatchAugment(batch_augment_ops) if batch_augment_ops else None
+        self.converter = converter
+        self.batch_max_length = batch_max_length
+        self.uint8_transport = uint8_transport
+        if resize_backend not in ['pil', 'tensor']:
+            raise ValueError('resize_backend should be pil or tensor')
+        self.resize_backend = resize_backend
+        self.size_multiple = size_multiple if dynamic_size and keep_ratio_with_pad else None
+        self.pad_direction = 'right' if self.size_multiple and page_orient == 'horizontal' else 'bottom'
 
     def __call__(self, batch):
+        image_tensors, labels = self.collate(batch)
+        if self.converter is None:
+            return image_tensors, labels
+        text, length = self.converter.encode_batch(labels, self.batch_max_length)
+        return image_tensors, labels, text, length
+
+    def collate(self, batch):
         batch = filter(lambda x: x is not None, batch)
         images, labels = zip(*batch)
 
+        if isinstance(images[0], torch.Tensor):  # pre-resized uint8 images from NpyShardDataset
+            image_tensors = torch.stack(images)
+            if self.batch_augment is not None:
+                return self.augment_batch(image_tensors), labels
+            if self.uint8_transport:
+                sizes = torch.LongTensor([[self.imgH, self.imgW]]).repeat(len(images), 1)
+                return Uint8Batch(image_tensors, sizes), labels
+            image_tensors = image_tensors.float().div_(255).sub_(0.5).div_(0.5)
+            return image_tensors, labels
+
         if self.augment:
-            images = [ocrodeg.ocrodeg_simple_augment(img) for img in images]
+            images = [self.augment_image(img) for img in images]
             # images[0].show()
 
-        if self.keep_ratio_with_pad:  # same concept with 'Rosetta' paper
-            input_channel = 3 if images[0].mode == 'RGB' else 1
-            transform = NormalizePAD_vertical((input_channel, self.imgH, self.imgW))
+        # resize every image straight into one uint8 batch buffer, then normalize the whole batch at once.
+        # this gives the same values as ToTensor + sub_(0.5).div_(0.5) per image.
+        resize_batch = resize_batch_tensor if self.resize_backend == 'tensor' else resize_batch_pil
+        batch_array, resized_sizes = resize_batch(images, self.imgH, self.imgW, self.keep_ratio_with_pad,
+                                                  self.pad_direction, self.size_multiple)
 
-            resized_images = []
-            for image in images:
-                w, h = image.size
-                ratio = h / float(w)
-                if math.ceil(self.imgW * ratio) > self.imgH:
-                    resized_h = self.imgH
-                else:
-                    resized_h = math.ceil(self.imgW * ratio)
+        if self.batch_augment is not None:  # the padding is augmented along with the image
+            batch_array = replicate_pad(batch_array, resized_sizes)
+            return self.augment_batch(torch.from_numpy(batch_array)), labels
 
-                resized_image = image.resize((self.imgW, resized_h), Image.BICUBIC)
-                resized_images.append(transform(resized_image))
-                # resized_image.save('./image_test/%d_test.jpg' % w)
+        if self.uint8_transport:  # padding is left to normalize_batch
+            return Uint8Batch(torch.from_numpy(batch_array), torch.from_numpy(resized_sizes)), labels
 
-            image_tensors = torch.cat([t.unsqueeze(0) for t in resized_images], 0)
+        batch_array = replicate_pad(batch_array, resized_sizes)
+        image_tensors = torch.from_numpy(batch_array).float().div_(255).sub_(0.5).div_(0.5)
+        return image_tensors, labels
 
+    def augment_image(self, img):
+        if self.augment_mode == 'full':
+            return ocrodeg.ocrodeg_augment(img, self.texture_bank)
+        return ocrodeg.ocrodeg_simple_augment(img)
+
+    def augment_batch(self, image_tensors):
+        """ BatchAugment a padded uint8 batch, return it normalized, or requantized as a Uint8Batch """
+        image_tensors = self.batch_augment(image_tensors.float().div_(255))
+        if self.uint8_transport:
+            sizes = torch.LongTensor([list(image_tensors.shape[2:])]).repeat(len(image_tensors), 1)
+            return Uint8Batch(image_tensors.mul_(255).round_().to(torch.uint8), sizes)
+        return image_tensors.sub_(0.5).div_(0.5)
+
+
+def resized_size(w, h, imgH, imgW, keep_ratio_with_pad=False, pad_direction='bottom'):
+    """
+    (height, width) of a w x h image resized by AlignCollate. With keep_ratio_with_pad the ratio is kept
+    (same concept with 'Rosetta' paper): the width is imgW for pad_direction 'bottom', the height is imgH for 'right'.
+    """
+    if not keep_ratio_with_pad:
+        return imgH, imgW
+    if pad_direction == 'right':
+        ratio = w / float(h)
+        if math.ceil(imgH * ratio) > imgW:
+            return imgH, imgW
+        return imgH, math.ceil(imgH * ratio)
+    ratio = h / float(w)
+    if math.ceil(imgW * ratio) > imgH:
+        return imgH, imgW
+    return math.ceil(imgW * ratio), imgW
+
+
+def resize_image(image, imgH, imgW, keep_ratio_with_pad=False):
+    """
+    resize a PIL image to imgW x imgH, or with keep_ratio_with_pad to imgW x resized_h keeping the ratio.
+    return the resized image and resized_h.
+    """
+    resized_h = resized_size(*image.size, imgH, imgW, keep_ratio_with_pad)[0]
+    return image.resize((imgW, resized_h), Image.BICUBIC), resized_h
+
+
+def new_batch_array(images, resized_sizes, imgH, imgW, size_multiple=None):
+    """
+    uninitialized uint8 [B, C, H, W] array for the resized images. H x W is imgH x imgW, or with size_multiple
+    the largest resized height and width rounded up to size_multiple, at least two strides.
+    """
+    input_channel = 3 if images[0].mode == 'RGB' else 1
+    if size_multiple is None:
+        height, width = imgH, imgW
+    else:
+        height, width = np.maximum(-(-resized_sizes.max(axis=0) // size_multiple), 2) * size_multiple
+    return np.empty((len(images), input_channel, height, width), dtype=np.uint8)
+
+
+def resize_batch_pil(images, imgH, imgW, keep_ratio_with_pad=False, pad_direction='bottom', size_multiple=None):
+    """
+    resize PIL images one by one into a uint8 batch array (see new_batch_array).
+    return the array, whose pixels outside the resized images are not filled, and the resized (h, w) of each image.
+    """
+    resized_sizes = np.array([resized_size(*image.size, imgH, imgW, keep_ratio_with_pad, pad_direction)
+                              for image in images], dtype=np.int64).reshape(-1, 2)
+    batch_array = new_batch_array(images, resized_sizes, imgH, imgW, size_multiple)
+    for i, image in enumerate(images):
+        h, w = resized_sizes[i]
+        array = np.asarray(image.resize((int(w), int(h)), Image.BICUBIC), dtype=np.uint8)
+        if array.ndim == 2:
+            batch_array[i, 0, :h, :w] = array
         else:
-            transform = ResizeNormalize((self.imgW, self.imgH))
-            image_tensors = [transform(image) for image in images]
-            image_tensors = torch.cat([t.unsqueeze(0) for t in image_tensors], 0)
-
-        return image_tensors, labels
+            batch_array[i, :, :h, :w] = array.transpose(2, 0, 1)
+    return batch_array, resized_sizes
+
+
+def bicubic_taps(in_sizes, out_sizes, out_length):
+    """
+    the 1d bicubic resize (a=-0.5, antialias when downscaling) of rows of in_sizes[i] pixels to out_sizes[i] pixels,
+    with the coefficients of PIL Image.resize: output pixel j of row i is sum_k weights[i, j, k] * row[taps[i, j, k]].
+    return int64 taps and float32 weights [B, out_length, num_taps], the weights past out_sizes[i] are zero.
+    """
+    scale = in_sizes / out_sizes
+    filter_scale = np.maximum(scale, 1.0)
+    support = 2.0 * filter_scale
+    num_taps = min(int(np.ceil(2 * support.max())) + 2, int(in_sizes.max()) + 1)
+    centers = (np.arange(out_length)[None, :] + 0.5) * scale[:, None]  # B x out_length
+    first_taps = np.maximum(np.floor(centers - support[:, None] + 0.5), 0).astype(np.int64)
+    taps = first_taps[:, :, None] + np.arange(num_taps)
+    x = np.abs(taps - centers[:, :, None] + 0.5) / filter_scale[:, None, None]
+    a = -0.5
+    weights = np.where(x < 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1.0,
+                       np.where(x < 2.0, (((x - 5.0) * x + 8.0) * x - 4.0) * a, 0.0))
+    weights *= taps < in_sizes[:, None, None]
+    weights *= np.arange(out_length)[None, :, None] < out_sizes[:, None, None]
+    total = weights.sum(axis=2, keepdims=True)
+    weights /= np.where(total > 0, total, 1.0)
+    taps = np.minimum(taps, in_sizes[:, None, None] - 1)  # any pixel of the row, their weight is zero
+    return taps, weights.astype(np.float32)
+
+
+def resample_last_dim(batch, taps, weights):
+    """
+    batch [B, C, H, W] float, taps and weights [B, out_length, num_taps] of bicubic_taps.
+    return [B, C, H, out_length] rounded and clipped to 0-255 like each pass of PIL, one gather per tap.
+    """
+    B, C, H, _ = batch.shape
+    out_length = taps.size(1)
+    result = batch.new_zeros(B, C, H, out_length)
+    for k in range(taps.size(2)):
+        index = taps[:, None, None, :, k].expand(B, C, H, out_length)
+        result += batch.gather(3, index) * weights[:, None, None, :, k]
+    return result.add_(0.5).floor_().clamp_(0, 255)
+
+
+def size_groups(sizes):
+    """ indices of the images grouped by height and width within a factor of sqrt(2), which bounds the padding """
+    bins = np.ceil(np.log2(np.maximum(sizes, 1)) * 2).astype(np.int64)
+    groups = defaultdict(list)
+    for i, key in enumerate(map(tuple, bins)):
+        groups[key].append(i)
+    return list(groups.values())
+
+
+def resize_batch_tensor(images, imgH, imgW, keep_ratio_with_pad=False, pad_direction='bottom', size_multiple=None):
+    """
+    same as resize_batch_pil, but the images are resized group by group (see size_groups): a group is stacked
+    into one tensor, resized horizontally then vertically like PIL, each pass a few batched gathers with the
+    per-image bicubic_taps. The resized pixels differ from PIL bicubic by at most 1, see benchmark_resize.py.
+    """
+    resized_sizes = np.array([resized_size(*image.size, imgH, imgW, keep_ratio_with_pad, pad_direction)
+                              for image in images], dtype=np.int64).reshape(-1, 2)
+    batch_array = new_batch_array(images, resized_sizes, imgH, imgW, size_multiple)
+    input_channel = batch_array.shape[1]
+    sizes = np.array([image.size[::-1] for image in images], dtype=np.int64).reshape(-1, 2)  # (h, w)
+
+    for indices in size_groups(sizes):
+        group_sizes, group_resized_sizes = sizes[indices], resized_sizes[indices]
+        max_h, max_w = group_sizes.max(axis=0)
+        out_h, out_w = group_resized_sizes.max(axis=0)
+        arrays = np.zeros((len(indices), max_h, max_w, input_channel), dtype=np.uint8)
+        for position, i in enumerate(indices):
+            h, w = sizes[i]
+            arrays[position, :h, :w] = np.asarray(images[i], dtype=np.uint8).reshape(h, w, input_channel)
+
+        taps_w, weights_w = bicubic_taps(group_sizes[:, 1], group_resized_sizes[:, 1], out_w)
+        taps_h, weights_h = bicubic_taps(group_sizes[:, 0], group_resized_sizes[:, 0], out_h)
+        group = torch.from_numpy(arrays).permute(0, 3, 1, 2).float()
+        group = resample_last_dim(group, torch.from_numpy(taps_w), torch.from_numpy(weights_w))
+        group = resample_last_dim(group.transpose(2, 3), torch.from_numpy(taps_h), torch.from_numpy(weights_h))
+        # the pixels past resized_sizes are in the pad region of batch_array
+        batch_array[indices, :, :out_h, :out_w] = group.transpose(2, 3).to(torch.uint8).numpy()
+    return batch_array, resized_sizes
+
+
+def replicate_pad(batch_array, resized_sizes):
+    """
+    batch_array: [B, C, H, W], the top left resized_sizes[i] (h, w) pixels of image i are valid.
+    fill the rest by replicating the last valid row (like NormalizePAD_vertical) and column (like NormalizePAD),
+    one gather per padded axis.
+    """
+    height, width = batch_array.shape[2:]
+    if (resized_sizes[:, 0] != height).any():
+        rows = np.minimum(np.arange(height)[None, :], resized_sizes[:, 0:1] - 1)
+        batch_array = np.take_along_axis(batch_array, rows[:, None, :, None], axis=2)
+    if (resized_sizes[:, 1] != width).any():
+        cols = np.minimum(np.arange(width)[None, :], resized_sizes[:, 1:2] - 1)
+        batch_array = np.take_along_axis(batch_array, cols[:, None, None, :], axis=3)
+    return batch_array
+
+
+def resize_to_array(image, imgH, imgW, keep_ratio_with_pad=False):
+    """
+    resize a PIL image exactly as AlignCollate does and return it as uint8 array [C, imgH, imgW].
+    With keep_ratio_with_pad the bottom border is replicated like NormalizePAD_vertical.
+    """
+    image, resized_h = resize_image(image, imgH, imgW, keep_ratio_with_pad)
+    array = np.asarray(image, dtype=np.uint8)
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+    array = array.transpose(2, 0, 1)
+    if resized_h != imgH:
+        array = np.concatenate([array, np.repeat(array[:, -1:, :], imgH - resized_h, axis=1)], axis=1)
+    return np.ascontiguousarray(array)
 
 
 def tensor2im(image_tensor, imtype=np.uint8):
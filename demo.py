@@ -12,8 +12,9 @@ import torch.nn.functional as F
 import numpy as np
 from PIL import Image, ImageDraw
 
-from utils import CTCLabelConverter, AttnLabelConverter
-from dataset import RawDataset, AlignCollate
+from utils import CTCLabelConverter, AttnLabelConverter, masked_confidence
+from charset import CHARSET_NAMES, PRINTABLE_CHARACTER, read_charset_file
+from dataset import RawDataset, AlignCollate, normalize_batch
 from model import Model
 
 device = None
@@ -43,7 +44,9 @@ def demo(opt):
     model.load_state_dict(torch.load(opt.saved_model, map_location=device))
 
     # prepare data. two demo images from https://github.com/bgshih/crnn#run-demo
-    AlignCollate_demo = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+    AlignCollate_demo = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                     uint8_transport=opt.uint8_transport, resize_backend=opt.resize_backend,
+                                     dynamic_size=opt.dynamic_size, page_orient=opt.page_orient)
     demo_data = RawDataset(root=opt.image_folder, opt=opt)  # use RawDataset
     demo_loader = torch.utils.data.DataLoader(
         demo_data, batch_size=opt.batch_size,
@@ -55,8 +58,8 @@ def demo(opt):
     model.eval()
     with torch.no_grad():
         for image_tensors, image_path_list in demo_loader:
-            batch_size = image_tensors.size(0)
-            image = image_tensors.to(device)
+            image = normalize_batch(image_tensors, device)
+            batch_size = image.size(0)
             # For max length prediction
             length_for_pred = torch.IntTensor([opt.batch_max_length] * batch_size).to(device)
             text_for_pred = torch.LongTensor(batch_size, opt.batch_max_length + 1).fill_(0).to(device)
@@ -93,6 +96,8 @@ def demo(opt):
                     topk_id = topk_id.detach().cpu().numpy()  # (batch_size, topk)
                     topk_probs = topk_prob.detach().cpu()
                     topk_strs = converter.decode(topk_id, length_for_pred)
+                    # confidence score (= multiply of pred_max_prob) of the best candidates, pruned after [s]
+                    _, best_confidences = converter.decode_batch(topk_id[:, :, 0], length_for_pred, topk_probs[:, :, 0])
 
             if opt.batch_max_length == 1:
                 log = open(f'./log_demo_result.csv', 'a', encoding='utf-8')
@@ -170,15 +175,7 @@ def demo(opt):
                                     img.save(os.path.join('output', os.path.basename(img_name)))
 
                         best_pred = pred[0]
-                        best_prob = pred_max_prob[:, 0]
-
-                        # calculate confidence score (= multiply of pred_max_prob)
-                        try:
-                            confidence_score = best_prob.cumprod(dim=0)[-1]
-                        except IndexError:
-                            confidence_score = 0.0
-                            # print(f'{img_name:25s}\t{pred:25s}\t can\'t predict')
-                            # raise ValueError()
+                        confidence_score = best_confidences[idx]
                         print(f'{img_name:25s}\t{best_pred:25s}\t{confidence_score:0.4f}')
                         log.write(f'{img_name:25s}\t{best_pred:25s}\t{confidence_score:0.4f}\n')
                         for i in range(k):
@@ -190,17 +187,10 @@ def demo(opt):
                 else:
                     preds_prob = F.softmax(preds, dim=2)
                     preds_max_prob, _ = preds_prob.max(dim=2)
-                    for img_name, pred, pred_max_prob, pred_idx in zip(image_path_list, preds_str, preds_max_prob,
-                                                                       preds_index):
-                        pred_EOS = len(pred)
-                        pred_max_prob = pred_max_prob[:pred_EOS]
-                        # calculate confidence score (= multiply of pred_max_prob)
-                        try:
-                            confidence_score = pred_max_prob.cumprod(dim=0)[-1]
-                        except IndexError:
-                            confidence_score = 0.0
-                            # print(f'{img_name:25s}\t{pred:25s}\t can\'t predict')
-                            # raise ValueError()
+                    # confidence score (= multiply of pred_max_prob) of the first len(pred) steps
+                    confidence_scores = masked_confidence(preds_max_prob, [len(pred) for pred in preds_str])
+                    for img_name, pred, confidence_score, pred_idx in zip(image_path_list, preds_str,
+                                                                          confidence_scores, preds_index):
                         if opt.output_split:
                             img = Image.open(img_name).convert('RGB')
                             width, height = img.size
@@ -272,6 +262,15 @@ if __name__ == '__main__':
     parser.add_argument('--character', type=str, default='0123456789abcdefghijklmnopqrstuvwxyz', help='character label')
     parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--uint8_transport', action='store_true',
+                        help='send uint8 batches from the DataLoader workers, padded and normalized on the device')
+    parser.add_argument('--resize_backend', type=str, default='pil', choices=['pil', 'tensor'],
+                        help='resize images one by one with PIL, or in groups of similar size with batched torch gathers '
+                             '(the bicubic coefficients of PIL)')
+    parser.add_argument('--dynamic_size', action='store_true',
+                        help='with --PAD, pad each batch only to its largest image (right for horizontal page_orient)')
+    parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'pil_draft', 'cv2'],
+                        help='image decoder, pil_draft and cv2 decode large images at a reduced size covering imgH x imgW')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str, required=True, help='Transformation stage. None|TPS')
     parser.add_argument('--FeatureExtraction', type=str, required=True, help='FeatureExtraction stage. VGG|RCNN|ResNet')
@@ -297,15 +296,11 @@ if __name__ == '__main__':
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     """ vocab / character number configuration """
-    if opt.character in ['CN-s', 'CN-m', 'CN-l', 'CN-xl']:
-        size = opt.character.split('-')[-1]
-        with open('charset/charset_' + size + '.txt', 'r', encoding='utf-8') as chars:
-            charset = [c.strip() for c in chars]
-        charset = ''.join(charset)
-        opt.character = charset
+    if opt.character in CHARSET_NAMES:
+        opt.character = read_charset_file(opt.character)
     elif opt.sensitive:
         # opt.character += 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        opt.character = string.printable[:-6]  # same with ASTER setting (use 94 char).
+        opt.character = PRINTABLE_CHARACTER  # same with ASTER setting (use 94 char).
     else:
         raise ValueError
 
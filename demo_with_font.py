@@ -10,6 +10,7 @@ import torch.utils.data
 import torch.nn.functional as F
 
 from utils import CTCLabelConverter, AttnLabelConverter
+from charset import CHARSET_NAMES, PRINTABLE_CHARACTER, read_charset_file
 from dataset import RawDataset, AlignCollate, FontDataset
 from model import Model
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -146,14 +147,10 @@ if __name__ == '__main__':
     opt = parser.parse_args()
 
     """ vocab / character number configuration """
-    if opt.character in ['CN-s', 'CN-m', 'CN-l', 'CN-xl']:
-        size = opt.character.split('-')[-1]
-        with open('charset/charset_' + size + '.txt', 'r', encoding='utf-8') as chars:
-            charset = [c.strip() for c in chars]
-        charset = ''.join(charset)
-        opt.character = charset
+    if opt.character in CHARSET_NAMES:
+        opt.character = read_charset_file(opt.character)
     elif opt.sensitive:
-        opt.character = string.printable[:-6]  # same with ASTER setting (use 94 char).
+        opt.character = PRINTABLE_CHARACTER  # same with ASTER setting (use 94 char).
 
     cudnn.benchmark = True
     cudnn.deterministic = True
@@ -12,6 +12,8 @@ from tqdm import tqdm
 import lmdb
 import json
 
+from lmdb_meta import metaKey, unpack_meta, has_meta
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -26,11 +28,15 @@ def get_lmdb_statistics(root):
     env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
     with env.begin(write=False) as txn:
         nSamples = int(txn.get('num-samples'.encode()))
+        use_meta = has_meta(txn)
         for index in tqdm(range(nSamples)):
             index += 1  # lmdb starts with 1
-            label_key = 'label-%09d'.encode() % index
-            label = txn.get(label_key).decode('utf-8')
-            length_map[len(label)] += 1
+            if use_meta:
+                label_length = unpack_meta(txn.get(metaKey(index)))[3]
+            else:
+                label_key = 'label-%09d'.encode() % index
+                label_length = len(txn.get(label_key).decode('utf-8'))
+            length_map[label_length] += 1
     return length_map
 
 
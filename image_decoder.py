@@ -0,0 +1,64 @@
+import six
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:  # only needed by the 'cv2' backend
+    cv2 = None
+
+DECODERS = ['pil', 'pil_draft', 'cv2']
+
+
+def reduction_factor(width, height, target_size, factors=(8, 4, 2)):
+    """ the largest factor whose reduced image still covers target_size (w, h), 1 if none does """
+    target_w, target_h = target_size
+    for factor in factors:
+        if width // factor >= target_w and height // factor >= target_h:
+            return factor
+    return 1
+
+
+def decode_image(imgbuf, rgb=False, target_size=None, backend='pil'):
+    """
+    Decode an encoded image buffer into a 'L' (or 'RGB') PIL image.
+    backend:
+        pil       : full resolution decode, then convert
+        pil_draft : let the JPEG decoder downscale in the DCT domain (1/2, 1/4, 1/8) with Image.draft,
+                    to the smallest size which still covers target_size (w, h). Other formats are decoded fully.
+        cv2       : cv2.imdecode with IMREAD_REDUCED_GRAYSCALE_* / IMREAD_REDUCED_COLOR_*,
+                    with the largest reduction which still covers target_size.
+    The reduced decodes are only used when target_size is given. Raise IOError for a corrupted image.
+    """
+    mode = 'RGB' if rgb else 'L'
+    if backend == 'pil':
+        return Image.open(six.BytesIO(imgbuf)).convert(mode)
+
+    elif backend == 'pil_draft':
+        img = Image.open(six.BytesIO(imgbuf))
+        if target_size is not None:
+            img.draft(mode, target_size)  # no-op for non JPEG images
+        return img.convert(mode)
+
+    elif backend == 'cv2':
+        if cv2 is None:
+            raise ImportError('the cv2 decoder needs opencv-python')
+        factor = 1
+        if target_size is not None:
+            width, height = Image.open(six.BytesIO(imgbuf)).size  # only parses the header
+            factor = reduction_factor(width, height, target_size)
+        if rgb:
+            flag = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                    4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}[factor]
+        else:
+            flag = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                    4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}[factor]
+        img = cv2.imdecode(np.frombuffer(imgbuf, dtype=np.uint8), flag)
+        if img is None:
+            raise IOError('cv2 cannot decode the image')
+        if rgb:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return Image.fromarray(img)
+
+    else:
+        raise ValueError(f'decoder should be one of {DECODERS}')
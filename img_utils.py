@@ -1,61 +1,69 @@
-import random
 from PIL import Image, ImageFilter, ImageFont, ImageDraw
 import numpy as np
 from torch import nn
 from torchvision import transforms
 
+from rng_utils import get_rng
 
-def salt_and_pepper_noise(img, proportion=0.05):
-    noise_img = np.array(img)
-    height, width = noise_img.shape
+
+def salt_and_pepper_noise_array(noise_img, proportion=0.05, rng=None):
+    """ set height * width * proportion random pixels (drawn with replacement) of a uint8 array to 0 or 255 """
+    rng = get_rng() if rng is None else rng
+    height, width = noise_img.shape[:2]
     num = int(height * width * proportion)  # how many points to be salt and peper noise point
-    for i in range(num):
-        w = random.randint(0, width - 1)
-        h = random.randint(0, height - 1)
-        if random.randint(0, 1) == 0:
-            noise_img[h, w] = 0
-        else:
-            noise_img[h, w] = 255
-    noise_img = Image.fromarray(noise_img)
+    noise_img = noise_img.copy()
+    hs = rng.integers(0, height, num)
+    ws = rng.integers(0, width, num)
+    values = rng.integers(0, 2, num).astype(np.uint8) * 255
+    noise_img[hs, ws] = values if noise_img.ndim == 2 else values[:, None]
     return noise_img
 
 
+def gauss_noise_array(image, mu=0, sigma=10, rng=None):
+    """ add gaussian noise to a uint8 array, one value per pixel for all its channels """
+    rng = get_rng() if rng is None else rng
+    noise = rng.normal(mu, sigma, image.shape[:2])
+    if image.ndim == 3:
+        noise = noise[:, :, None]
+    # clip in float, this step avoids pixels smaller than 0 or larger than 255, the cast truncates like the int16 image did
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def salt_and_pepper_noise(img, proportion=0.05):
+    return Image.fromarray(salt_and_pepper_noise_array(np.array(img), proportion))
+
+
 def gauss_noise(image):
-    image = np.array(image)
-    img = image.astype(np.int16)  # 此步是为了避免像素点小于0，大于255的情况
-    mu = 0
-    sigma = 10
-    for i in range(img.shape[0]):
-        for j in range(img.shape[1]):
-            img[i, j] = img[i, j] + random.gauss(mu=mu, sigma=sigma)
-    img[img > 255] = 255
-    img[img < 0] = 0
-    img = img.astype(np.uint8)
-    img = Image.fromarray(img)
-    return img
+    return Image.fromarray(gauss_noise_array(np.array(image)))
 
 
 def img_augment(img, crop_threshold=0.3, blur_threshold=0.3, salt_pepper_threshold=0.5, gauss_threshold=0.5):
+    """
+    random zoom in crop, gaussian blur, salt and pepper and gaussian noise of a PIL image.
+    The crop is a single resize of the cropped box, crop and blur stay in PIL, which is fastest for them,
+    and both noises work on one uint8 array, converted back to PIL once.
+    """
+    rng = get_rng()
     w, h = img.size
-    if random.random() < crop_threshold:
-        multiplier = random.uniform(1.0, 1.2)
+    if rng.random() < crop_threshold:
+        multiplier = rng.uniform(1.0, 1.2)
         # add an eps to prevent cropping issue
         nw = int(multiplier * w) + 1
         nh = int(multiplier * h) + 1
-        img = img.resize((nw, nh), Image.BICUBIC)
-
-        shift_x = random.randint(0, max(nw - w - 1, 0))
-        shift_y = random.randint(0, max(nh - h - 1, 0))
-        img = img.crop((shift_x, shift_y, shift_x + w, shift_y + h))
-    if random.random() < blur_threshold:
+        shift_x = rng.integers(0, max(nw - w - 1, 0) + 1)
+        shift_y = rng.integers(0, max(nh - h - 1, 0) + 1)
+        # the w x h crop at (shift_x, shift_y) of the image resized to nw x nh, in the coordinates of the image
+        box = (shift_x * w / nw, shift_y * h / nh, (shift_x + w) * w / nw, (shift_y + h) * h / nh)
+        img = img.resize((w, h), Image.BICUBIC, box=box)
+    if rng.random() < blur_threshold:
         sigma_list = [1, 1.5, 2]
-        sigma = random.choice(sigma_list)
-        img = img.filter(ImageFilter.GaussianBlur(radius=sigma))
-    if random.random() < salt_pepper_threshold:
-        img = salt_and_pepper_noise(img)
-    if random.random() < gauss_threshold:
-        img = gauss_noise(img)
-    return img
+        img = img.filter(ImageFilter.GaussianBlur(radius=sigma_list[rng.integers(len(sigma_list))]))
+    img = np.asarray(img)
+    if rng.random() < salt_pepper_threshold:
+        img = salt_and_pepper_noise_array(img, rng=rng)
+    if rng.random() < gauss_threshold:
+        img = gauss_noise_array(img, rng=rng)
+    return Image.fromarray(img)
 
 
 def draw_single_char(ch, font, canvas_size, x_offset=0, y_offset=0):
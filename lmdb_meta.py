@@ -0,0 +1,109 @@
+import os
+import sys
+
+import argparse
+import struct
+import zlib
+import six
+import lmdb
+from multiprocessing import Pool
+from PIL import Image
+from tqdm import tqdm
+
+# per-sample metadata record stored under 'meta-%09d':
+# width, height, channels, label length (in characters), image size in bytes, crc32 of the image bytes
+META_STRUCT = struct.Struct('<IIBHII')
+
+
+# set to the number of samples once every sample has a metadata record
+NUM_META_KEY = 'num-meta'.encode()
+
+
+def metaKey(index):
+    return 'meta-%09d'.encode() % index
+
+
+def has_meta(txn):
+    num_meta = txn.get(NUM_META_KEY)
+    return num_meta is not None and num_meta == txn.get('num-samples'.encode())
+
+
+def pack_meta(imageBin, label):
+    """ build the metadata record of one sample, the image is not decoded, only its header is parsed """
+    try:
+        img = Image.open(six.BytesIO(imageBin))
+        width, height = img.size
+        channels = len(img.getbands())
+    except (IOError, TypeError):
+        width, height, channels = 0, 0, 0
+    size = len(imageBin) if imageBin is not None else 0
+    crc = zlib.crc32(imageBin) if imageBin is not None else 0
+    return META_STRUCT.pack(width, height, channels, min(len(label), 0xFFFF), size, crc)
+
+
+def unpack_meta(metaBin):
+    """ return (width, height, channels, label_length, image_size, crc32) """
+    return META_STRUCT.unpack(metaBin)
+
+
+def _compute_meta(args):
+    root, start, end = args
+    env = lmdb.open(root, max_readers=126, readonly=True, readahead=False, meminit=False)
+    results = []
+    with env.begin(write=False) as txn:
+        for index in range(start, end):
+            imageBin = txn.get('image-%09d'.encode() % index)
+            label = txn.get('label-%09d'.encode() % index).decode('utf-8')
+            results.append((metaKey(index), pack_meta(imageBin, label)))
+    env.close()
+    return results
+
+
+def backfillMeta(root, workers=8, chunk_size=10000, overwrite=False, map_size=1099511627776):
+    """
+    Compute the 'meta-%09d' records of an existing LMDB dataset in parallel and write them into it.
+    ARGS:
+        root       : LMDB path
+        workers    : number of processes which read and parse the images
+        chunk_size : number of samples per task
+        overwrite  : recompute the records even if the LMDB already has them
+    """
+    env = lmdb.open(root, max_readers=126, readonly=True, readahead=False, meminit=False)
+    with env.begin(write=False) as txn:
+        nSamples = int(txn.get('num-samples'.encode()))
+        skip = not overwrite and has_meta(txn)
+    # closed before forking, the workers open their own environment and an environment must not be
+    # opened twice in one process
+    env.close()
+    if skip:
+        print(f'{root} already has metadata, skip')
+        return
+
+    tasks = [(root, start, min(start + chunk_size, nSamples + 1)) for start in range(1, nSamples + 1, chunk_size)]
+    with Pool(workers) as pool:
+        env = lmdb.open(root, map_size=map_size)  # after the workers are forked
+        for results in tqdm(pool.imap_unordered(_compute_meta, tasks), total=len(tasks)):
+            with env.begin(write=True) as txn:
+                for k, v in results:
+                    txn.put(k, v)
+    with env.begin(write=True) as txn:
+        txn.put(NUM_META_KEY, str(nSamples).encode())
+    env.close()
+    print('Written metadata of %d samples in %s' % (nSamples, root))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', type=str, nargs='+', help='LMDB dataset paths')
+    parser.add_argument('--workers', type=int, default=8, help='number of processes')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='number of samples per task')
+    parser.add_argument('--overwrite', action='store_true', help='recompute existing metadata')
+    parser.add_argument('--map_size', type=int, default=1099511627776, help='lmdb dataset size')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for path in args.paths:
+        backfillMeta(path, args.workers, args.chunk_size, args.overwrite, args.map_size)
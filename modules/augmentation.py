@@ -0,0 +1,128 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# in the order they are applied, like ocrodeg_augment: distort before binary blur, then noise
+BATCH_AUGMENT_OPS = ['elastic', 'blur', 'saltpepper', 'gaussian']
+
+
+def gaussian_kernels(sigma, truncate=4.0):
+    """
+    sigma : per-sample standard deviation [batch_size]
+    output : normalized 1d gaussian kernels [batch_size x (2*radius+1)], the radius of the largest sigma
+             truncated like ndi.gaussian_filter
+    """
+    radius = int(truncate * float(sigma.max()) + 0.5)
+    x = torch.arange(-radius, radius + 1, device=sigma.device, dtype=sigma.dtype)
+    kernels = torch.exp(-0.5 * (x[None] / sigma[:, None]) ** 2)
+    return kernels / kernels.sum(1, keepdim=True)
+
+
+def gaussian_blur(images, sigma, truncate=4.0):
+    """
+    separable depthwise gaussian blur with a per-sample sigma.
+    The borders are zero padded and renormalized by the kernel mass inside the image (normalized convolution),
+    so a kernel larger than the image, like the one of elastic_distort, does not smear the border pixels inwards.
+    images : [batch_size x C x H x W], sigma : [batch_size]
+    """
+    B, C, H, W = images.shape
+    kernels = gaussian_kernels(sigma.to(images.dtype), truncate).repeat_interleave(C, 0)[:, None, None, :]
+    radius = kernels.size(-1) // 2
+    x = images.reshape(1, B * C, H, W)
+    x = F.conv2d(x, kernels, padding=(0, radius), groups=B * C)
+    x = F.conv2d(x, kernels.transpose(2, 3), padding=(radius, 0), groups=B * C)
+    mass_w = F.conv2d(x.new_ones(1, B * C, 1, W), kernels, padding=(0, radius), groups=B * C)
+    mass_h = F.conv2d(x.new_ones(1, B * C, H, 1), kernels.transpose(2, 3), padding=(radius, 0), groups=B * C)
+    return (x / (mass_h * mass_w)).reshape(B, C, H, W)
+
+
+def batch_quantile(values, q):
+    """ per-row quantile q [batch_size] of values [batch_size x N], linear interpolation like np.percentile """
+    sorted_values = values.sort(dim=1)[0]
+    position = q.to(values.dtype) * (values.size(1) - 1)
+    lower = position.floor().long()
+    upper = position.ceil().long()
+    lower_values = sorted_values.gather(1, lower[:, None])[:, 0]
+    upper_values = sorted_values.gather(1, upper[:, None])[:, 0]
+    return lower_values + (upper_values - lower_values) * (position - lower.to(values.dtype))
+
+
+class BatchAugment(nn.Module):
+    """
+    ocrodeg style augmentation of a whole collated batch at once, instead of one PIL image at a time.
+    Every op is applied to each sample with probability prob, with its own random parameters.
+        elastic: distort_with_noise(bounded_gaussian_noise) with grid_sample
+        blur: binary_blur, which keeps the fraction of black pixels of each sample
+        saltpepper: set random pixels to black or white
+        gaussian: add gaussian noise
+    The default ('blur',) is ocrodeg_simple_augment.
+    It runs in the DataLoader workers (AlignCollate(batch_augment_ops=...)) or in the trainer on the device batch.
+    """
+
+    def __init__(self, ops=('blur',), prob=0.5, blur_sigma=(0.5, 0.7), blur_noise=(0.05, 0.1),
+                 elastic_sigma=(12.0, 20.0), elastic_maxdelta=(3.0, 7.0), saltpepper_amount=(0.001, 0.01),
+                 gaussian_std=(0.02, 0.08)):
+        super(BatchAugment, self).__init__()
+        for op in ops:
+            if op not in BATCH_AUGMENT_OPS:
+                raise ValueError(f'unknown batch augment op {op}, should be one of {BATCH_AUGMENT_OPS}')
+        self.ops = [op for op in BATCH_AUGMENT_OPS if op in ops]
+        self.prob = prob
+        self.blur_sigma = blur_sigma
+        self.blur_noise = blur_noise
+        self.elastic_sigma = elastic_sigma
+        self.elastic_maxdelta = elastic_maxdelta
+        self.saltpepper_amount = saltpepper_amount
+        self.gaussian_std = gaussian_std
+
+    @torch.no_grad()
+    def forward(self, images):
+        """
+        input : images in [0, 1] [batch_size x C x H x W]
+        output : augmented images in [0, 1] [batch_size x C x H x W]
+        """
+        for op in self.ops:
+            apply = torch.rand(images.size(0), device=images.device) < self.prob
+            index = apply.nonzero(as_tuple=True)[0]
+            if len(index) > 0:
+                images = images.index_put((index,), getattr(self, op)(images[index]))
+        return images
+
+    @staticmethod
+    def uniform(images, limits):
+        lo, hi = limits
+        return torch.rand(images.size(0), device=images.device, dtype=images.dtype) * (hi - lo) + lo
+
+    def blur(self, images):
+        B = images.size(0)
+        sigma = self.uniform(images, self.blur_sigma)
+        noise = self.uniform(images, self.blur_noise)
+        percent_black = (images.reshape(B, -1) < 0.5).to(images.dtype).mean(1)
+        blurred = gaussian_blur(images, sigma).reshape(B, -1)
+        blurred = blurred + torch.randn_like(blurred) * noise[:, None]
+        threshold = batch_quantile(blurred, percent_black)
+        return (blurred > threshold[:, None]).to(images.dtype).reshape(images.shape)
+
+    def elastic(self, images):
+        B, C, H, W = images.shape
+        sigma = self.uniform(images, self.elastic_sigma)
+        maxdelta = self.uniform(images, self.elastic_maxdelta)
+        deltas = gaussian_blur(torch.rand(B, 2, H, W, device=images.device, dtype=images.dtype), sigma)
+        lo = deltas.amin((1, 2, 3), keepdim=True)
+        hi = deltas.amax((1, 2, 3), keepdim=True)
+        deltas = (2 * (deltas - lo) / (hi - lo).clamp_min(1e-12) - 1) * maxdelta[:, None, None, None]  # pixels
+        ys = torch.arange(H, device=images.device, dtype=images.dtype)[None, :, None] + deltas[:, 0]
+        xs = torch.arange(W, device=images.device, dtype=images.dtype)[None, None, :] + deltas[:, 1]
+        grid = torch.stack([xs * 2 / max(W - 1, 1) - 1, ys * 2 / max(H - 1, 1) - 1], dim=3)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='reflection', align_corners=True)
+
+    def saltpepper(self, images):
+        B, C, H, W = images.shape
+        amount = self.uniform(images, self.saltpepper_amount)
+        mask = torch.rand(B, 1, H, W, device=images.device) < amount[:, None, None, None]
+        salt = (torch.rand(B, 1, H, W, device=images.device) < 0.5).to(images.dtype)
+        return torch.where(mask, salt, images)
+
+    def gaussian(self, images):
+        std = self.uniform(images, self.gaussian_std)
+        return (images + torch.randn_like(images) * std[:, None, None, None]).clamp_(0.0, 1.0)
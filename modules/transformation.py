@@ -17,6 +17,7 @@ class TPS_SpatialTransformerNetwork(nn.Module):
             I_channel_num : the number of channels of the input image I
         output:
             batch_I_r: rectified image [batch_size x I_channel_num x I_r_height x I_r_width]
+        An input whose size differs from I_size (dynamic size batches) is rectified to its own size instead of I_r_size.
         """
         super(TPS_SpatialTransformerNetwork, self).__init__()
         self.F = F
@@ -27,9 +28,10 @@ class TPS_SpatialTransformerNetwork(nn.Module):
         self.GridGenerator = GridGenerator(self.F, self.I_r_size)
 
     def forward(self, batch_I):
+        I_r_size = self.I_r_size if tuple(batch_I.shape[2:]) == tuple(self.I_size) else tuple(batch_I.shape[2:])
         batch_C_prime = self.LocalizationNetwork(batch_I)  # batch_size x K x 2
-        build_P_prime = self.GridGenerator.build_P_prime(batch_C_prime)  # batch_size x n (= I_r_width x I_r_height) x 2
-        build_P_prime_reshape = build_P_prime.reshape([build_P_prime.size(0), self.I_r_size[0], self.I_r_size[1], 2])
+        build_P_prime = self.GridGenerator.build_P_prime(batch_C_prime, I_r_size)  # batch_size x n (= I_r_width x I_r_height) x 2
+        build_P_prime_reshape = build_P_prime.reshape([build_P_prime.size(0), I_r_size[0], I_r_size[1], 2])
         
         if torch.__version__ > "1.2.0":
             batch_I_r = F.grid_sample(batch_I, build_P_prime_reshape, padding_mode='border', align_corners=True)
@@ -97,6 +99,7 @@ class GridGenerator(nn.Module):
         ## for multi-gpu, you need register buffer
         self.register_buffer("inv_delta_C", torch.tensor(self._build_inv_delta_C(self.F, self.C)).float())  # F+3 x F+3
         self.register_buffer("P_hat", torch.tensor(self._build_P_hat(self.F, self.C, self.P)).float())  # n x F+3
+        self.P_hat_cache = {}  # P_hat of other I_r_size, for dynamic size batches
         ## for fine-tuning with different image width, you may use below instead of self.register_buffer
         #self.inv_delta_C = torch.tensor(self._build_inv_delta_C(self.F, self.C)).float().cuda()  # F+3 x F+3
         #self.P_hat = torch.tensor(self._build_P_hat(self.F, self.C, self.P)).float().cuda()  # n x F+3
@@ -152,11 +155,22 @@ class GridGenerator(nn.Module):
         P_hat = np.concatenate([np.ones((n, 1)), P, rbf], axis=1)
         return P_hat  # n x F+3
 
-    def build_P_prime(self, batch_C_prime):
-        """ Generate Grid from batch_C_prime [batch_size x F x 2] """
+    def get_P_hat(self, I_r_size=None):
+        """ P_hat of the I_r_size (height, width) grid, built once per size """
+        if I_r_size is None or tuple(I_r_size) == (self.I_r_height, self.I_r_width):
+            return self.P_hat
+        # keyed by device too, the DataParallel replicas share this dict
+        key = (tuple(I_r_size), self.P_hat.device)
+        if key not in self.P_hat_cache:
+            P = self._build_P(I_r_size[1], I_r_size[0])
+            self.P_hat_cache[key] = torch.tensor(self._build_P_hat(self.F, self.C, P)).float().to(self.P_hat.device)
+        return self.P_hat_cache[key]
+
+    def build_P_prime(self, batch_C_prime, I_r_size=None):
+        """ Generate Grid from batch_C_prime [batch_size x F x 2], for I_r_size if given """
         batch_size = batch_C_prime.size(0)
         batch_inv_delta_C = self.inv_delta_C.repeat(batch_size, 1, 1)
-        batch_P_hat = self.P_hat.repeat(batch_size, 1, 1)
+        batch_P_hat = self.get_P_hat(I_r_size).repeat(batch_size, 1, 1)
         batch_C_prime_with_zeros = torch.cat((batch_C_prime, torch.zeros(
             batch_size, 3, 2).float().to(device)), dim=1)  # batch_size x F+3 x 2
         batch_T = torch.bmm(batch_inv_delta_C, batch_C_prime_with_zeros)  # batch_size x F+3 x 2
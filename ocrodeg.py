@@ -1,16 +1,19 @@
 import os
 import sys
 
+import argparse
 import random
 import time
 import warnings
+from functools import lru_cache
 
 import numpy as np
-import pylab
 import scipy.ndimage as ndi
 from PIL import Image
 from tqdm import tqdm
 
+from rng_utils import get_rng
+
 
 def autoinvert(image):
     assert np.amin(image) >= 0
@@ -61,7 +64,7 @@ def transform_image(image, angle=0.0, scale=1.0, aniso=1.0, translation=(0, 0),
 
 def bounded_gaussian_noise(shape, sigma, maxdelta):
     n, m = shape
-    deltas = pylab.rand(2, n, m)
+    deltas = get_rng().random((2, n, m))
     deltas = ndi.gaussian_filter(deltas, (0, sigma, sigma))
     deltas -= np.amin(deltas)
     deltas /= np.amax(deltas)
@@ -81,7 +84,7 @@ def distort_with_noise(image, deltas, order=1):
 
 def noise_distort1d(shape, sigma=100.0, magnitude=100.0):
     h, w = shape
-    noise = ndi.gaussian_filter(pylab.randn(w), sigma)
+    noise = ndi.gaussian_filter(get_rng().standard_normal(w), sigma)
     noise *= magnitude / np.amax(abs(noise))
     dys = np.array([noise] * h)
     deltas = np.array([dys, np.zeros((h, w))])
@@ -102,7 +105,7 @@ def binary_blur(image, sigma, noise=0.0):
     p = percent_black(image)
     blurred = ndi.gaussian_filter(image, sigma)
     if noise > 0:
-        blurred += pylab.randn(*blurred.shape) * noise
+        blurred += get_rng().standard_normal(blurred.shape) * noise
     t = np.percentile(blurred, p)
     return np.array(blurred > t, 'f')
 
@@ -111,19 +114,40 @@ def binary_blur(image, sigma, noise=0.0):
 # multiscale noise
 #
 
+@lru_cache(maxsize=1024)
+def zoom_matrix(n_in, scale, n_out):
+    """
+    [n_out, n_in] matrix which zooms n_in samples by scale, cropped to the first n_out outputs.
+    The output coordinates are those of ndi.zoom; the interpolation is cubic convolution (Keys, a = -0.5),
+    which is separable, so a 2d field is zoomed by two small matrix products instead of a 16 tap spline per pixel.
+    """
+    n_zoom = int(round(n_in * scale))
+    x = np.arange(n_out) * ((n_in - 1) / (n_zoom - 1) if n_zoom > 1 else 0.0)
+    i0 = np.floor(x).astype(np.int64)
+    t = (x - i0)[:, None]
+    weights = np.concatenate([((-0.5 * t + 1.0) * t - 0.5) * t,
+                              (1.5 * t - 2.5) * t * t + 1.0,
+                              ((-1.5 * t + 2.0) * t + 0.5) * t,
+                              (0.5 * t - 0.5) * t * t], axis=1)
+    index = np.clip(i0[:, None] + np.arange(-1, 3)[None, :], 0, n_in - 1)
+    matrix = np.zeros((n_out, n_in))
+    np.add.at(matrix, (np.repeat(np.arange(n_out), 4), index.reshape(-1)), weights.reshape(-1))
+    return matrix
+
+
 def make_noise_at_scale(shape, scale):
     h, w = shape
     h0, w0 = int(h / scale + 1), int(w / scale + 1)
-    data = pylab.rand(h0, w0)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        result = ndi.zoom(data, scale)
-    return result[:h, :w]
+    data = get_rng().random((h0, w0))
+    if scale == 1.0:
+        return data[:h, :w]
+    return zoom_matrix(h0, scale, h) @ data @ zoom_matrix(w0, scale, w).T
 
 
 def make_multiscale_noise(shape, scales, weights=None, limits=(0.0, 1.0)):
     if weights is None:
         weights = [1.0] * len(scales)
+    # the first scale is counted twice, as it always was
     result = make_noise_at_scale(shape, scales[0]) * weights[0]
     for s, w in zip(scales, weights):
         result += make_noise_at_scale(shape, s) * w
@@ -137,14 +161,15 @@ def make_multiscale_noise(shape, scales, weights=None, limits=(0.0, 1.0)):
 
 def make_multiscale_noise_uniform(shape, srange=(1.0, 100.0), nscales=4, limits=(0.0, 1.0)):
     lo, hi = np.log10(srange[0]), np.log10(srange[1])
-    scales = np.random.uniform(size=nscales)
+    rng = get_rng()
+    scales = rng.uniform(size=nscales)
     scales = np.add.accumulate(scales)
     scales -= np.amin(scales)
     scales /= np.amax(scales)
     scales *= hi - lo
     scales += lo
     scales = 10 ** scales
-    weights = 2.0 * np.random.uniform(size=nscales)
+    weights = 2.0 * rng.uniform(size=nscales)
     return make_multiscale_noise(shape, scales, weights=weights, limits=limits)
 
 
@@ -153,19 +178,19 @@ def make_multiscale_noise_uniform(shape, srange=(1.0, 100.0), nscales=4, limits=
 #
 
 def random_blobs(shape, blobdensity, size, roughness=2.0):
-    from random import randint
-    from builtins import range  # python2 compatible
     h, w = shape
     numblobs = int(blobdensity * w * h)
+    if numblobs == 0:  # the normalization below divides by zero and no pixel passes the threshold
+        return np.zeros((h, w), 'f')
+    rng = get_rng()
     mask = np.zeros((h, w), 'i')
-    for i in range(numblobs):
-        mask[randint(0, h - 1), randint(0, w - 1)] = 1
+    mask[rng.integers(0, h, numblobs), rng.integers(0, w, numblobs)] = 1
     dt = ndi.distance_transform_edt(1 - mask)
     mask = np.array(dt < size, 'f')
     mask = ndi.gaussian_filter(mask, size / (2 * roughness))
     mask -= np.amin(mask)
     mask /= np.amax(mask)
-    noise = pylab.rand(h, w)
+    noise = rng.random((h, w))
     noise = ndi.gaussian_filter(noise, size / (2 * roughness))
     noise -= np.amin(noise)
     noise /= np.amax(noise)
@@ -182,29 +207,29 @@ def random_blotches(image, fgblobs, bgblobs, fgscale=10, bgscale=10):
 # random fibers
 #
 
-def make_fiber(l, a, stepsize=0.5):
-    angles = np.random.standard_cauchy(l) * a
-    angles[0] += 2 * np.pi * pylab.rand()
-    angles = np.add.accumulate(angles)
-    coss = np.add.accumulate(np.cos(angles) * stepsize)
-    sins = np.add.accumulate(np.sin(angles) * stepsize)
-    return np.array([coss, sins]).transpose((1, 0))
+def make_fiber(l, a, stepsize=0.5, nfibers=None):
+    """ a random walk of l steps, [l, 2] (y, x) offsets, or [nfibers, l, 2] if nfibers is given """
+    rng = get_rng()
+    angles = rng.standard_cauchy((nfibers or 1, l)) * a
+    angles[:, 0] += 2 * np.pi * rng.random(nfibers or 1)
+    angles = np.add.accumulate(angles, axis=1)
+    coss = np.add.accumulate(np.cos(angles) * stepsize, axis=1)
+    sins = np.add.accumulate(np.sin(angles) * stepsize, axis=1)
+    fibers = np.stack([coss, sins], axis=2)
+    return fibers if nfibers is not None else fibers[0]
 
 
 def make_fibrous_image(shape, nfibers=300, l=300, a=0.2, stepsize=0.5, limits=(0.1, 1.0), blur=1.0):
     h, w = shape
     lo, hi = limits
+    rng = get_rng()
     result = np.zeros(shape)
-    for i in range(nfibers):
-        v = pylab.rand() * (hi - lo) + lo
-        fiber = make_fiber(l, a, stepsize=stepsize)
-        y, x = random.randint(0, h - 1), random.randint(0, w - 1)
-        fiber[:, 0] += y
-        fiber[:, 0] = np.clip(fiber[:, 0], 0, h - .1)
-        fiber[:, 1] += x
-        fiber[:, 1] = np.clip(fiber[:, 1], 0, w - .1)
-        for y, x in fiber:
-            result[int(y), int(x)] = v
+    # all fibers at once, later fibers overwrite earlier ones like drawing them one by one
+    values = rng.random(nfibers) * (hi - lo) + lo
+    fibers = make_fiber(l, a, stepsize=stepsize, nfibers=nfibers)
+    ys = np.clip(fibers[:, :, 0] + rng.integers(0, h, nfibers)[:, None], 0, h - .1).astype(np.int64)
+    xs = np.clip(fibers[:, :, 1] + rng.integers(0, w, nfibers)[:, None], 0, w - .1).astype(np.int64)
+    result[ys.reshape(-1), xs.reshape(-1)] = np.repeat(values, l)
     result = ndi.gaussian_filter(result, blur)
     result -= np.amin(result)
     result /= np.amax(result)
@@ -213,27 +238,106 @@ def make_fibrous_image(shape, nfibers=300, l=300, a=0.2, stepsize=0.5, limits=(0
     return result
 
 
+#
+# pre-generated noise textures
+#
+
+# channels of a texture bank: noise of make_multiscale_noise_uniform, the paper and ink noise of
+# printlike_fibrous and the fibers of make_fibrous_image, all in [0, 1]
+TEXTURE_KINDS = ['multiscale', 'paper', 'ink', 'fiber']
+
+
+def build_texture_bank(path, num_textures=8, size=1024, fibers_per_pixel=300 / (128 * 512)):
+    """
+    Generate num_textures size x size textures of every kind and save them as uint8
+    [num_textures, len(TEXTURE_KINDS), size, size] .npy (0-255 for 0-1) for TextureBank.
+    The fibers keep the density printlike_fibrous has on a 128 x 512 image.
+    """
+    shape = (size, size)
+    nfibers = int(round(fibers_per_pixel * size * size))
+    textures = np.empty((num_textures, len(TEXTURE_KINDS), size, size), dtype=np.uint8)
+    for i in tqdm(range(num_textures)):
+        fields = {
+            'multiscale': make_multiscale_noise_uniform(shape),
+            'paper': make_multiscale_noise(shape, [1.0, 5.0, 10.0, 50.0], weights=[1.0, 0.3, 0.5, 0.3]),
+            'ink': make_multiscale_noise(shape, [1.0, 5.0, 10.0, 50.0]),
+            'fiber': make_fibrous_image(shape, nfibers, 500, 0.01, limits=(0.0, 1.0), blur=0.5),
+        }
+        for k, kind in enumerate(TEXTURE_KINDS):
+            textures[i, k] = np.round(fields[kind] * 255)
+    np.save(path, textures)
+    print(f'Saved {num_textures} textures of {size}x{size} to {path}')
+
+
+class TextureBank(object):
+    """
+    Noise textures of build_texture_bank, memory-mapped read-only and opened lazily in each process,
+    so the DataLoader workers share the same pages instead of generating the noise for every sample.
+    """
+
+    def __init__(self, path, scale_range=(0.75, 1.33)):
+        self.path = path
+        self.scale_range = scale_range
+        self.textures = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['textures'] = None  # reopened by the worker, not pickled
+        return state
+
+    def sample(self, kind, shape, limits=(0.0, 1.0)):
+        """
+        a shape crop of a random texture of kind at a random position, scale and flip, mapped to limits.
+        Images larger than the textures wrap around.
+        """
+        if self.textures is None:
+            self.textures = np.load(self.path, mmap_mode='r')
+        rng = get_rng()
+        h, w = shape
+        num_textures, _, size_h, size_w = self.textures.shape
+        texture = self.textures[rng.integers(num_textures), TEXTURE_KINDS.index(kind)]
+        scale = rng.uniform(*self.scale_range)
+        rows = (rng.integers(size_h) + np.arange(h) / scale).astype(np.int64) % size_h
+        cols = (rng.integers(size_w) + np.arange(w) / scale).astype(np.int64) % size_w
+        if rng.random() < 0.5:
+            rows = rows[::-1]
+        if rng.random() < 0.5:
+            cols = cols[::-1]
+        lo, hi = limits
+        return texture[np.ix_(rows, cols)] * ((hi - lo) / 255.0) + lo
+
+
 #
 # print-like degradation with multiscale noise
 #
 
-def printlike_multiscale(image, blur=0.5, blotches=5e-5, paper_range=(0.8, 1.0), ink_range=(0.0, 0.2)):
+def printlike_multiscale(image, blur=0.5, blotches=5e-5, paper_range=(0.8, 1.0), ink_range=(0.0, 0.2), bank=None):
     selector = autoinvert(image)
     # selector = random_blotches(selector, 3 * blotches, blotches)
     selector = random_blotches(selector, 2 * blotches, blotches)
-    paper = make_multiscale_noise_uniform(image.shape, limits=paper_range)
-    ink = make_multiscale_noise_uniform(image.shape, limits=ink_range)
+    if bank is not None:
+        paper = bank.sample('multiscale', image.shape, limits=paper_range)
+        ink = bank.sample('multiscale', image.shape, limits=ink_range)
+    else:
+        paper = make_multiscale_noise_uniform(image.shape, limits=paper_range)
+        ink = make_multiscale_noise_uniform(image.shape, limits=ink_range)
     blurred = ndi.gaussian_filter(selector, blur)
     printed = blurred * ink + (1 - blurred) * paper
     return printed
 
 
-def printlike_fibrous(image, blur=0.5, blotches=5e-5, paper_range=(0.8, 1.0), ink_range=(0.0, 0.2)):
+def printlike_fibrous(image, blur=0.5, blotches=5e-5, paper_range=(0.8, 1.0), ink_range=(0.0, 0.2), bank=None):
     selector = autoinvert(image)
     selector = random_blotches(selector, 2 * blotches, blotches)
-    paper = make_multiscale_noise(image.shape, [1.0, 5.0, 10.0, 50.0], weights=[1.0, 0.3, 0.5, 0.3], limits=paper_range)
-    paper -= make_fibrous_image(image.shape, 300, 500, 0.01, limits=(0.0, 0.25), blur=0.5)
-    ink = make_multiscale_noise(image.shape, [1.0, 5.0, 10.0, 50.0], limits=ink_range)
+    if bank is not None:
+        paper = bank.sample('paper', image.shape, limits=paper_range)
+        paper -= bank.sample('fiber', image.shape, limits=(0.0, 0.25))
+        ink = bank.sample('ink', image.shape, limits=ink_range)
+    else:
+        paper = make_multiscale_noise(image.shape, [1.0, 5.0, 10.0, 50.0], weights=[1.0, 0.3, 0.5, 0.3],
+                                      limits=paper_range)
+        paper -= make_fibrous_image(image.shape, 300, 500, 0.01, limits=(0.0, 0.25), blur=0.5)
+        ink = make_multiscale_noise(image.shape, [1.0, 5.0, 10.0, 50.0], limits=ink_range)
     blurred = ndi.gaussian_filter(selector, blur)
     printed = blurred * ink + (1 - blurred) * paper
     return printed
@@ -251,7 +355,8 @@ def test():
     img.show()
 
 
-def ocrodeg_augment(img):
+def ocrodeg_augment(img, bank=None):
+    """ distort, binary blur and print-like noise of a grayscale image, with the noise of bank if given """
     img = np.array(img)
     # 50% use distort, 50% use raw
     flag = 0
@@ -284,9 +389,9 @@ def ocrodeg_augment(img):
     # flag=2 - 10% use multiscale, 10% use fibrous, 80% use raw
     rnd = random.random()
     if rnd < 0.4 - flag * 0.15:
-        img = printlike_multiscale(img, blur=0.5)
+        img = printlike_multiscale(img, blur=0.5, bank=bank)
     elif rnd < 0.8 - flag * 0.15:
-        img = printlike_fibrous(img)
+        img = printlike_fibrous(img, bank=bank)
 
     img = (img * 255).astype(np.uint8)
     img = Image.fromarray(img)
@@ -309,22 +414,17 @@ def ocrodeg_simple_augment(img):
     return img
 
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_path', type=str, required=True, help='.npy file of the texture bank')
+    parser.add_argument('--num_textures', type=int, default=8, help='number of textures of each kind')
+    parser.add_argument('--size', type=int, default=1024, help='height and width of the textures')
+    parser.add_argument('--seed', type=int, default=1111, help='random seed')
+    args = parser.parse_args()
+    return args
+
+
 if __name__ == '__main__':
-    img_array_list = []
-    for p in os.listdir('diaolong'):
-        img_path = os.path.join('diaolong', p)
-        img = Image.open(img_path).convert('L')
-        img = np.array(img)
-        img = img / 255
-        img_array_list.append(img)
-    st = time.time()
-    for img in img_array_list:
-        img = printlike_fibrous(img)
-        # img = binary_blur(img, random.uniform(0.5, 0.7), random.uniform(0.05, 0.1))
-        zerooneimshow(img)
-    et = time.time()
-    print(et - st)
-    # distort_with_noise 28.50s
-    # binary_blur 4.79s
-    # multiscale 98.98s
-    # fibrous 113.01s
+    args = parse_args()
+    random.seed(args.seed)
+    build_texture_bank(args.output_path, args.num_textures, args.size)
@@ -0,0 +1,20 @@
+import os
+import random
+
+import numpy as np
+
+_rng = None
+_rng_pid = None
+
+
+def get_rng():
+    """
+    np.random.Generator shared by the augmentations of ocrodeg.py and img_utils.py. It is seeded from the
+    random module, so random.seed and the per-worker seeding of the DataLoader fix it too,
+    and a new one is made in every (forked) process.
+    """
+    global _rng, _rng_pid
+    if _rng is None or _rng_pid != os.getpid():
+        _rng = np.random.default_rng(random.getrandbits(64))
+        _rng_pid = os.getpid()
+    return _rng
@@ -13,7 +13,8 @@ import numpy as np
 from nltk.metrics.distance import edit_distance
 
 from utils import CTCLabelConverter, AttnLabelConverter, Averager
-from dataset import hierarchical_dataset, AlignCollate
+from charset import CHARSET_NAMES, PRINTABLE_CHARACTER, read_charset_file
+from dataset import hierarchical_dataset, AlignCollate, lmdb_worker_init_fn, normalize_batch
 from model import Model
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -40,13 +41,17 @@ def benchmark_all_eval(model, criterion, converter, opt, calculate_infer_time=Fa
     log.write(dashed_line + '\n')
     for eval_data in eval_data_list:
         eval_data_path = os.path.join(opt.eval_data, eval_data)
-        AlignCollate_evaluation = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+        AlignCollate_evaluation = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                               uint8_transport=opt.uint8_transport,
+                                               resize_backend=opt.resize_backend,
+                                               dynamic_size=opt.dynamic_size, page_orient=opt.page_orient)
         eval_data, eval_data_log = hierarchical_dataset(root=eval_data_path, opt=opt)
         evaluation_loader = torch.utils.data.DataLoader(
             eval_data, batch_size=evaluation_batch_size,
             shuffle=False,
             num_workers=int(opt.workers),
-            collate_fn=AlignCollate_evaluation, pin_memory=True)
+            collate_fn=AlignCollate_evaluation, pin_memory=True,
+            worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
 
         _, accuracy_by_best_model, norm_ED_by_best_model, _, _, _, infer_time, length_of_data = validation(
             model, criterion, evaluation_loader, converter, opt)
@@ -84,15 +89,19 @@ def validation(model, criterion, evaluation_loader, converter, opt):
     infer_time = 0
     valid_loss_avg = Averager()
 
-    for i, (image_tensors, labels) in enumerate(evaluation_loader):
-        batch_size = image_tensors.size(0)
+    for i, batch in enumerate(evaluation_loader):
+        image_tensors, labels = batch[:2]
+        image = normalize_batch(image_tensors, device)
+        batch_size = image.size(0)
         length_of_data = length_of_data + batch_size
-        image = image_tensors.to(device)
         # For max length prediction
         length_for_pred = torch.IntTensor([opt.batch_max_length] * batch_size).to(device)
         text_for_pred = torch.LongTensor(batch_size, opt.batch_max_length + 1).fill_(0).to(device)
 
-        text_for_loss, length_for_loss = converter.encode(labels, batch_max_length=opt.batch_max_length)
+        if len(batch) == 4:  # labels already encoded, e.g. by ValidationCache
+            text_for_loss, length_for_loss = batch[2].to(device), batch[3].to(device)
+        else:
+            text_for_loss, length_for_loss = converter.encode(labels, batch_max_length=opt.batch_max_length)
 
         start_time = time.time()
         if 'CTC' in opt.Prediction:
@@ -104,9 +113,8 @@ def validation(model, criterion, evaluation_loader, converter, opt):
             # permute 'preds' to use CTCloss format
             cost = criterion(preds.log_softmax(2).permute(1, 0, 2), text_for_loss, preds_size, length_for_loss)
 
-            # Select max probabilty (greedy decoding) then decode index to character
+            # Select max probabilty (greedy decoding)
             _, preds_index = preds.max(2)
-            preds_str = converter.decode(preds_index.data, preds_size.data)
 
         else:
             preds, alphas = model(image, text_for_pred, is_train=False)
@@ -116,25 +124,23 @@ def validation(model, criterion, evaluation_loader, converter, opt):
             target = text_for_loss[:, 1:]  # without [GO] Symbol
             cost = criterion(preds.contiguous().view(-1, preds.shape[-1]), target.contiguous().view(-1))
 
-            # select max probabilty (greedy decoding) then decode index to character
+            # select max probabilty (greedy decoding)
             _, preds_index = preds.max(2)
-            preds_str = converter.decode(preds_index, length_for_pred)
-            labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
 
         infer_time += forward_time
         valid_loss_avg.add(cost)
 
-        # calculate accuracy & confidence score
+        # calculate accuracy & confidence score (= multiply of pred_max_prob)
         preds_prob = F.softmax(preds, dim=2)
         preds_max_prob, _ = preds_prob.max(dim=2)
-        confidence_score_list = []
-        for gt, pred, pred_max_prob in zip(labels, preds_str, preds_max_prob):
-            if 'Attn' in opt.Prediction:
-                gt = gt[:gt.find('[s]')]
-                pred_EOS = pred.find('[s]')
-                pred = pred[:pred_EOS]  # prune after "end of sentence" token ([s])
-                pred_max_prob = pred_max_prob[:pred_EOS]
-
+        # decode index to character
+        if 'CTC' in opt.Prediction:
+            preds_str, confidence_scores = converter.decode_batch(preds_index.data, preds_size.data, preds_max_prob)
+        else:  # pruned after "end of sentence" token ([s])
+            preds_str, confidence_scores = converter.decode_batch(preds_index, length_for_pred, preds_max_prob)
+            labels, _ = converter.decode_batch(text_for_loss[:, 1:], length_for_loss)
+        confidence_score_list = list(confidence_scores)
+        for gt, pred in zip(labels, preds_str):
             # To evaluate 'case sensitive model' with alphanumeric and case insensitve setting.
             if opt.sensitive and opt.data_filtering_off:
                 pred = pred.lower()
@@ -164,17 +170,6 @@ def validation(model, criterion, evaluation_loader, converter, opt):
             else:
                 norm_ED += 1 - edit_distance(pred, gt) / len(pred)
 
-            # calculate confidence score (= multiply of pred_max_prob)
-            try:
-                confidence_score = pred_max_prob.cumprod(dim=0)[-1]
-            except:
-                confidence_score = 0  # for empty pred case, when prune after "end of sentence" token ([s])
-            # log = open(f'./result/{opt.exp_name}/log_all_evaluation.txt', 'a')
-            # log.write(f'pred: {pred}, gt: {gt}, {pred == gt}, prob: {confidence_score:0.4f}\n')
-            # log.close()
-            confidence_score_list.append(confidence_score)
-            # print(pred, gt, pred == gt, confidence_score.item())
-
     accuracy = n_correct / float(length_of_data) * 100
     norm_ED = norm_ED / float(length_of_data)  # ICDAR2019 Normalized Edit Distance
 
@@ -189,15 +184,19 @@ def validation_by_length(model, criterion, evaluation_loader, converter, opt):
     infer_time = 0
     valid_loss_avg = Averager()
 
-    for i, (image_tensors, labels) in enumerate(evaluation_loader):
-        batch_size = image_tensors.size(0)
+    for i, batch in enumerate(evaluation_loader):
+        image_tensors, labels = batch[:2]
+        image = normalize_batch(image_tensors, device)
+        batch_size = image.size(0)
         # length_of_data = length_of_data + batch_size
-        image = image_tensors.to(device)
         # For max length prediction
         length_for_pred = torch.IntTensor([opt.batch_max_length] * batch_size).to(device)
         text_for_pred = torch.LongTensor(batch_size, opt.batch_max_length + 1).fill_(0).to(device)
 
-        text_for_loss, length_for_loss = converter.encode(labels, batch_max_length=opt.batch_max_length)
+        if len(batch) == 4:  # labels already encoded, e.g. by ValidationCache
+            text_for_loss, length_for_loss = batch[2].to(device), batch[3].to(device)
+        else:
+            text_for_loss, length_for_loss = converter.encode(labels, batch_max_length=opt.batch_max_length)
 
         start_time = time.time()
         if 'CTC' in opt.Prediction:
@@ -209,9 +208,8 @@ def validation_by_length(model, criterion, evaluation_loader, converter, opt):
             # permute 'preds' to use CTCloss format
             cost = criterion(preds.log_softmax(2).permute(1, 0, 2), text_for_loss, preds_size, length_for_loss)
 
-            # Select max probabilty (greedy decoding) then decode index to character
+            # Select max probabilty (greedy decoding)
             _, preds_index = preds.max(2)
-            preds_str = converter.decode(preds_index.data, preds_size.data)
 
         else:
             preds, alphas = model(image, text_for_pred, is_train=False)
@@ -221,25 +219,23 @@ def validation_by_length(model, criterion, evaluation_loader, converter, opt):
             target = text_for_loss[:, 1:]  # without [GO] Symbol
             cost = criterion(preds.contiguous().view(-1, preds.shape[-1]), target.contiguous().view(-1))
 
-            # select max probabilty (greedy decoding) then decode index to character
+            # select max probabilty (greedy decoding)
             _, preds_index = preds.max(2)
-            preds_str = converter.decode(preds_index, length_for_pred)
-            labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
 
         infer_time += forward_time
         valid_loss_avg.add(cost)
 
-        # calculate accuracy & confidence score
+        # calculate accuracy & confidence score (= multiply of pred_max_prob)
         preds_prob = F.softmax(preds, dim=2)
         preds_max_prob, _ = preds_prob.max(dim=2)
-        confidence_score_list = []
-        for gt, pred, pred_max_prob in zip(labels, preds_str, preds_max_prob):
-            if 'Attn' in opt.Prediction:
-                gt = gt[:gt.find('[s]')]
-                pred_EOS = pred.find('[s]')
-                pred = pred[:pred_EOS]  # prune after "end of sentence" token ([s])
-                pred_max_prob = pred_max_prob[:pred_EOS]
-
+        # decode index to character
+        if 'CTC' in opt.Prediction:
+            preds_str, confidence_scores = converter.decode_batch(preds_index.data, preds_size.data, preds_max_prob)
+        else:  # pruned after "end of sentence" token ([s])
+            preds_str, confidence_scores = converter.decode_batch(preds_index, length_for_pred, preds_max_prob)
+            labels, _ = converter.decode_batch(text_for_loss[:, 1:], length_for_loss)
+        confidence_score_list = list(confidence_scores)
+        for gt, pred in zip(labels, preds_str):
             # To evaluate 'case sensitive model' with alphanumeric and case insensitve setting.
             if opt.sensitive and opt.data_filtering_off:
                 pred = pred.lower()
@@ -271,17 +267,6 @@ def validation_by_length(model, criterion, evaluation_loader, converter, opt):
             else:
                 n_norm_ED[len(gt)] += 1 - edit_distance(pred, gt) / len(pred)
 
-            # calculate confidence score (= multiply of pred_max_prob)
-            try:
-                confidence_score = pred_max_prob.cumprod(dim=0)[-1]
-            except:
-                confidence_score = 0  # for empty pred case, when prune after "end of sentence" token ([s])
-            # log = open(f'./result/{opt.exp_name}/log_all_evaluation.txt', 'a')
-            # log.write(f'pred: {pred}, gt: {gt}, {pred == gt}, prob: {confidence_score:0.4f}\n')
-            # log.close()
-            confidence_score_list.append(confidence_score)
-            # print(pred, gt, pred == gt, confidence_score.item())
-
     accuracy = defaultdict(float)
     norm_ED = defaultdict(float)
     for k in n_correct.keys():
@@ -330,13 +315,17 @@ def test(opt):
             benchmark_all_eval(model, criterion, converter, opt)
         else:
             log = open(f'./result/{opt.exp_name}/log_evaluation.txt', 'a')
-            AlignCollate_evaluation = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+            AlignCollate_evaluation = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                                   uint8_transport=opt.uint8_transport,
+                                                   resize_backend=opt.resize_backend,
+                                                   dynamic_size=opt.dynamic_size, page_orient=opt.page_orient)
             eval_data, eval_data_log = hierarchical_dataset(root=opt.eval_data, opt=opt)
             evaluation_loader = torch.utils.data.DataLoader(
                 eval_data, batch_size=opt.batch_size,
                 shuffle=False,
                 num_workers=int(opt.workers),
-                collate_fn=AlignCollate_evaluation, pin_memory=True)
+                collate_fn=AlignCollate_evaluation, pin_memory=True,
+                worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
             # valid_loss_avg.val(), accuracy, norm_ED, preds_str, confidence_score_list, labels, infer_time, length_of_data
             if opt.by_length:
                 _, accuracy, norm_ED, preds_str, confidence_score_list, _, _, length_of_data = validation_by_length(
@@ -371,7 +360,20 @@ if __name__ == '__main__':
     parser.add_argument('--character', type=str, default='0123456789abcdefghijklmnopqrstuvwxyz', help='character label')
     parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--uint8_transport', action='store_true',
+                        help='send uint8 batches from the DataLoader workers, padded and normalized on the device')
+    parser.add_argument('--resize_backend', type=str, default='pil', choices=['pil', 'tensor'],
+                        help='resize images one by one with PIL, or in groups of similar size with batched torch gathers '
+                             '(the bicubic coefficients of PIL)')
+    parser.add_argument('--dynamic_size', action='store_true',
+                        help='with --PAD, pad each batch only to its largest image (right for horizontal page_orient)')
     parser.add_argument('--data_filtering_off', action='store_true', help='for data_filtering_off mode')
+    parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'pil_draft', 'cv2'],
+                        help='image decoder, pil_draft and cv2 decode large images at a reduced size covering imgH x imgW')
+    parser.add_argument('--lazy_lmdb', action='store_true',
+                        help='open lmdb lazily in each DataLoader worker and reuse one read transaction per worker')
+    parser.add_argument('--use_variants', action='store_true',
+                        help='read a random pre-rendered variant of each image from lmdbs made by create_augmented_lmdb.py')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str, required=True, help='Transformation stage. None|TPS')
     parser.add_argument('--FeatureExtraction', type=str, required=True, help='FeatureExtraction stage. VGG|RCNN|ResNet')
@@ -389,14 +391,10 @@ if __name__ == '__main__':
     opt = parser.parse_args()
 
     """ vocab / character number configuration """
-    if opt.character in ['CN-s', 'CN-m', 'CN-l', 'CN-xl']:
-        size = opt.character.split('-')[-1]
-        with open('charset/charset_' + size + '.txt', 'r', encoding='utf-8') as chars:
-            charset = [c.strip() for c in chars]
-        charset = ''.join(charset)
-        opt.character = charset
+    if opt.character in CHARSET_NAMES:
+        opt.character = read_charset_file(opt.character)
     elif opt.sensitive:
-        opt.character = string.printable[:-6]  # same with ASTER setting (use 94 char).
+        opt.character = PRINTABLE_CHARACTER  # same with ASTER setting (use 94 char).
 
     cudnn.benchmark = True
     cudnn.deterministic = True
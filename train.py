@@ -14,8 +14,11 @@ import numpy as np
 import pandas as pd
 
 from utils import CTCLabelConverter, AttnLabelConverter, Averager
-from dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset
+from charset import CHARSET_NAMES, PRINTABLE_CHARACTER, read_charset_file
+from dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset, BatchPrefetcher, lmdb_worker_init_fn, \
+    normalize_batch, build_validation_cache
 from model import Model
+from modules.augmentation import BatchAugment
 from test import validation
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -27,29 +30,41 @@ def train(opt):
         print('Filtering the images whose label is longer than opt.batch_max_length')
 
     opt.select_data = opt.select_data.split('-')
+    opt.batch_augment_ops = opt.batch_augment_ops.split('-')
     opt.batch_ratio = opt.batch_ratio.split('-')
-    train_dataset = Batch_Balanced_Dataset(opt)
+
+    """ label converter, used by the DataLoader workers with --collate_encode """
+    if 'CTC' in opt.Prediction:
+        converter = CTCLabelConverter(opt.character)
+    else:
+        converter = AttnLabelConverter(opt.character)
+    opt.num_class = len(converter.character)
+
+    train_dataset = Batch_Balanced_Dataset(opt, converter if opt.collate_encode else None)
 
     log = open(f'./saved_models/{opt.exp_name}/log_dataset.txt', 'a', encoding='utf-8')
-    AlignCollate_valid = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, augment=False)
+    AlignCollate_valid = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, augment=False,
+                                      uint8_transport=opt.uint8_transport, resize_backend=opt.resize_backend,
+                                      dynamic_size=opt.dynamic_size, page_orient=opt.page_orient)
     valid_dataset, valid_dataset_log = hierarchical_dataset(root=opt.valid_data, opt=opt)
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset, batch_size=opt.batch_size,
         shuffle=True,  # 'True' to check training progress with validation function.
         num_workers=int(opt.workers),
-        collate_fn=AlignCollate_valid, pin_memory=True)
+        collate_fn=AlignCollate_valid, pin_memory=True,
+        worker_init_fn=lmdb_worker_init_fn if opt.lazy_lmdb else None)
     log.write(valid_dataset_log)
     print('-' * 80)
     log.write('-' * 80 + '\n')
     log.close()
-    
-    """ model configuration """
-    if 'CTC' in opt.Prediction:
-        converter = CTCLabelConverter(opt.character)
-    else:
-        converter = AttnLabelConverter(opt.character)
-    opt.num_class = len(converter.character)
 
+    valid_cache = None
+    if opt.valid_cache != 'none':
+        valid_cache = build_validation_cache(
+            valid_loader, converter, opt,
+            mmap_path=f'./saved_models/{opt.exp_name}/valid_cache.bin' if opt.valid_cache == 'mmap' else None)
+
+    """ model configuration """
     if opt.rgb:
         opt.input_channel = 3
     model = Model(opt)
@@ -131,16 +146,35 @@ def train(opt):
         except:
             pass
 
+    batch_augment = None
+    if opt.batch_augment == 'trainer':
+        batch_augment = BatchAugment(opt.batch_augment_ops).to(device)
+
+    if opt.prefetch > 0:
+        train_prefetcher = BatchPrefetcher(train_dataset, converter, opt.batch_max_length, device, opt.prefetch)
+
     start_time = time.time()
     best_accuracy = -1
     best_norm_ED = -1
     iteration = start_iter
+    data_wait_time = 0
 
     while(True):
         # train part
-        image_tensors, labels = train_dataset.get_batch()
-        image = image_tensors.to(device)
-        text, length = converter.encode(labels, batch_max_length=opt.batch_max_length)
+        data_start_time = time.time()
+        if opt.prefetch > 0:
+            image, text, length, labels = train_prefetcher.get_batch()
+        else:
+            batch = train_dataset.get_batch()
+            image_tensors, labels = batch[:2]
+            image = normalize_batch(image_tensors, device)
+            if len(batch) == 4:  # encoded in the DataLoader workers with --collate_encode
+                text, length = batch[2].to(device), batch[3].to(device)
+            else:
+                text, length = converter.encode(labels, batch_max_length=opt.batch_max_length)
+        data_wait_time += time.time() - data_start_time
+        if batch_augment is not None:  # device compute, not counted in data_wait_time
+            image = batch_augment(image.mul(0.5).add_(0.5)).sub_(0.5).div_(0.5)
         batch_size = image.size(0)
 
         if 'CTC' in opt.Prediction:
@@ -168,12 +202,13 @@ def train(opt):
                 model.eval()
                 with torch.no_grad():
                     valid_loss, current_accuracy, current_norm_ED, preds, confidence_score, labels, infer_time, length_of_data = validation(
-                        model, criterion, valid_loader, converter, opt)
+                        model, criterion, valid_cache if valid_cache is not None else valid_loader, converter, opt)
                 model.train()
 
                 # training loss and validation loss
-                loss_log = f'[{iteration+1}/{opt.num_iter}] Train loss: {loss_avg.val():0.5f}, Valid loss: {valid_loss:0.5f}, Elapsed_time: {elapsed_time:0.5f}'
+                loss_log = f'[{iteration+1}/{opt.num_iter}] Train loss: {loss_avg.val():0.5f}, Valid loss: {valid_loss:0.5f}, Elapsed_time: {elapsed_time:0.5f}, Data_wait_time: {data_wait_time:0.5f}'
                 loss_avg.reset()
+                data_wait_time = 0
 
                 current_model_log = f'{"Current_accuracy":17s}: {current_accuracy:0.4f}, {"Current_norm_ED":17s}: {current_norm_ED:0.4f}'
 
@@ -194,11 +229,8 @@ def train(opt):
                 dashed_line = '-' * 80
                 head = f'{"Ground Truth":25s} | {"Prediction":25s} | Confidence Score & T/F'
                 predicted_result_log = f'{dashed_line}\n{head}\n{dashed_line}\n'
+                # validation returns the Attn labels and predictions already pruned after [s]
                 for gt, pred, confidence in zip(labels[:5], preds[:5], confidence_score[:5]):
-                    if 'Attn' in opt.Prediction:
-                        gt = gt[:gt.find('[s]')]
-                        pred = pred[:pred.find('[s]')]
-
                     predicted_result_log += f'{gt:25s} | {pred:25s} | {confidence:0.4f}\t{str(pred == gt)}\n'
                 predicted_result_log += f'{dashed_line}'
                 print(predicted_result_log)
@@ -226,6 +258,10 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', type=int, default=192, help='input batch size')
     parser.add_argument('--num_iter', type=int, default=300000, help='number of iterations to train for')
     parser.add_argument('--valInterval', type=int, default=2000, help='Interval between each validation')
+    parser.add_argument('--valid_cache', type=str, default='none', choices=['none', 'ram', 'mmap'],
+                        help='preprocess the validation set once and keep it in RAM or in a memory-mapped file')
+    parser.add_argument('--valid_cache_max_mb', type=int, default=4096,
+                        help='validate from the dataset when the validation cache would be larger')
     parser.add_argument('--saved_model', default='', help="path to model to continue training")
     parser.add_argument('--FT', action='store_true', help='whether to do fine-tuning')
     parser.add_argument('--adam', action='store_true', help='Whether to use adam (default is Adadelta)')
@@ -247,11 +283,49 @@ if __name__ == '__main__':
     parser.add_argument('--imgW', type=int, default=100, help='the width of the input image')
     parser.add_argument('--rgb', action='store_true', help='use rgb input')
     parser.add_argument('--augment', action='store_true', help='Use ocrodeg image augment')
+    parser.add_argument('--augment_mode', type=str, default='simple', choices=['simple', 'full'],
+                        help='simple: binary blur only, full: distort, binary blur and print-like paper / ink noise (grayscale only)')
+    parser.add_argument('--texture_bank', type=str, default=None,
+                        help='.npy texture bank (python ocrodeg.py --output_path ...) for the noise of --augment_mode full')
+    parser.add_argument('--batch_augment', type=str, default='none', choices=['none', 'worker', 'trainer'],
+                        help='augment whole batches with modules/augmentation.py, in the DataLoader workers '
+                             'or in the trainer on the device. independent of --augment')
+    parser.add_argument('--batch_augment_ops', type=str, default='blur',
+                        help='ops of --batch_augment, joined by -: elastic, blur, saltpepper, gaussian')
     parser.add_argument('--character', type=str, default='0123456789abcdefghijklmnopqrstuvwxyz',
                         help='CN-s, CN-m, CN-l, CN-xl or raw character label')
     parser.add_argument('--sensitive', action='store_true', help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true', help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--uint8_transport', action='store_true',
+                        help='send uint8 batches from the DataLoader workers, padded and normalized on the device')
+    parser.add_argument('--resize_backend', type=str, default='pil', choices=['pil', 'tensor'],
+                        help='resize images one by one with PIL, or in groups of similar size with batched torch gathers '
+                             '(the bicubic coefficients of PIL)')
+    parser.add_argument('--dynamic_size', action='store_true',
+                        help='with --PAD, pad each batch only to its largest image (right for horizontal page_orient)')
     parser.add_argument('--data_filtering_off', action='store_true', help='for data_filtering_off mode')
+    parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'pil_draft', 'cv2'],
+                        help='image decoder, pil_draft and cv2 decode large images at a reduced size covering imgH x imgW')
+    parser.add_argument('--lazy_lmdb', action='store_true',
+                        help='open lmdb lazily in each DataLoader worker and reuse one read transaction per worker')
+    parser.add_argument('--use_variants', action='store_true',
+                        help='read a random pre-rendered variant of each image from lmdbs made by create_augmented_lmdb.py')
+    parser.add_argument('--single_loader', action='store_true',
+                        help='use one DataLoader for all select_data sources, which keeps batch_ratio exactly per batch')
+    parser.add_argument('--bucket_sampler', action='store_true',
+                        help='batch samples of similar label length and aspect ratio instead of global shuffling, '
+                             'the per-source batches are then at most batch_size x batch_ratio, '
+                             'smaller for long labels, so batch_ratio holds only approximately')
+    parser.add_argument('--stream_shards', action='store_true',
+                        help='train on sequential record shards (create_stream_shards.py) instead of lmdb')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000,
+                        help='number of samples in the shuffle buffer of each worker with --stream_shards')
+    parser.add_argument('--label_index', action='store_true',
+                        help='read the training labels pre-encoded for the charset (create_label_index.py) from sidecars next to the lmdb / npy shards')
+    parser.add_argument('--collate_encode', action='store_true',
+                        help='encode the labels in the DataLoader workers instead of the training loop')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of batches assembled and encoded ahead in a background thread, 0 to disable')
 
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str, required=True, help='Transformation stage. None|TPS')
@@ -288,15 +362,11 @@ if __name__ == '__main__':
     """ vocab / character number configuration """
 
     """ vocab / character number configuration """
-    if opt.character in ['CN-s', 'CN-m', 'CN-l', 'CN-xl']:
-        size = opt.character.split('-')[-1]
-        with open('charset/charset_' + size + '.txt', 'r', encoding='utf-8') as chars:
-            charset = [c.strip() for c in chars]
-        charset = ''.join(charset)
-        opt.character = charset
+    if opt.character in CHARSET_NAMES:
+        opt.character = read_charset_file(opt.character)
     elif opt.sensitive:
         # opt.character += 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        opt.character = string.printable[:-6]  # same with ASTER setting (use 94 char).
+        opt.character = PRINTABLE_CHARACTER  # same with ASTER setting (use 94 char).
 
     """ Seed and GPU setting """
     # print("Random Seed: ", opt.manualSeed)
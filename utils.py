@@ -1,8 +1,34 @@
+import numpy as np
 import torch
 
+from charset import get_charset
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
+def to_numpy(x):
+    return x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+
+
+def join_indices(character, index, keep):
+    """ the string of the kept indices of every row of index [batch_size x T], looked up in the character list """
+    chars = list(map(character.__getitem__, index[keep].tolist()))
+    ends = np.cumsum(keep.sum(1)).tolist()
+    return [''.join(chars[start:end]) for start, end in zip([0] + ends[:-1], ends)]
+
+
+def masked_confidence(preds_max_prob, n):
+    """
+    confidence score (= multiply of pred_max_prob) of the first n steps of each sequence, 0 for n <= 0 (empty pred),
+    the same as pred_max_prob[:n].cumprod(dim=0)[-1] per sample.
+    preds_max_prob: [batch_size x T], n: [batch_size]
+    """
+    n = torch.as_tensor(n, dtype=torch.long, device=preds_max_prob.device).view(-1, 1)
+    steps = torch.arange(preds_max_prob.size(1), device=preds_max_prob.device).view(1, -1)
+    confidence = torch.where(steps < n, preds_max_prob, torch.ones_like(preds_max_prob)).prod(dim=1)
+    return confidence.masked_fill(n.view(-1) <= 0, 0)
+
+
 class CTCLabelConverter(object):
     """ Convert between text-label and text-index """
 
@@ -18,6 +44,8 @@ class CTCLabelConverter(object):
             self.dict[char] = i + 1
 
         self.character = ['[CTCblank]'] + dict_character  # dummy '[CTCblank]' token for CTCLoss (index 0)
+        self.charset = get_charset(character)
+        self.char_offset = len(list_token) + 1  # index of character[0]
 
     def encode(self, text, batch_max_length=25):
         """convert text-label into text-index.
@@ -29,34 +57,51 @@ class CTCLabelConverter(object):
             text: text index for CTCLoss. [batch_size, batch_max_length]
             length: length of each text. [batch_size]
         """
-        length = [len(s) for s in text]
+        batch_text, length = self.encode_batch(text, batch_max_length)
+        return (batch_text.to(device), length.to(device))
 
+    def encode_batch(self, text, batch_max_length=25):
+        """ encode on the CPU, all labels in one NumPy pass, so it can run in the DataLoader workers """
+        length, rows, cols, indices = self.lookup_batch(text)
         # The index used for padding (=0) would not affect the CTC loss calculation.
-        batch_text = torch.LongTensor(len(text), batch_max_length).fill_(0)
-        for i, t in enumerate(text):
-            text = list(t)
-            # text = [self.dict[char] for char in text]
-            text = [
-                self.dict[char] if self.dict.get(char) is not None else self.dict['[UNK]']
-                for char in text
-            ]
-            batch_text[i][:len(text)] = torch.LongTensor(text)
-        return (batch_text.to(device), torch.IntTensor(length).to(device))
+        batch_text = np.zeros((len(text), batch_max_length), dtype=np.int64)
+        batch_text[rows, cols] = indices
+        return (torch.from_numpy(batch_text), torch.from_numpy(length.astype(np.int32)))
+
+    def lookup_batch(self, text):
+        """
+        text-index of all text-labels at once through the codepoint lookup table of the charset, [UNK] if unknown.
+        The text-labels may also be int32 arrays of positions in the charset.
+        return the length of each label, and the row, column and index of every character
+        """
+        length = np.array([len(t) for t in text], dtype=np.int64)
+        if len(text) > 0 and isinstance(text[0], np.ndarray):  # charset positions, LmdbDataset(label_index=True)
+            positions = np.concatenate(text)
+        else:
+            positions = self.charset.lookup(self.charset.codepoints(''.join(text)))
+        indices = np.where(positions < 0, self.dict['[UNK]'], positions + self.char_offset)
+        rows = np.repeat(np.arange(len(text)), length)
+        cols = np.arange(len(indices)) - np.repeat(np.cumsum(length) - length, length)
+        return length, rows, cols, indices
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """
-        texts = []
-        for index, l in enumerate(length):
-            t = text_index[index, :]
+        return self.decode_batch(text_index, length)[0]
 
-            char_list = []
-            for i in range(l):
-                if t[i] != 0 and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank.
-                    char_list.append(self.character[t[i]])
-            text = ''.join(char_list)
-
-            texts.append(text)
-        return texts
+    def decode_batch(self, text_index, length, preds_max_prob=None):
+        """
+        convert all text-indices into text-labels at once, with masks on one NumPy copy of text_index.
+        With preds_max_prob [batch_size x T], also return the confidence score of each text-label,
+        the multiply of the max probabilities of all its steps, otherwise None.
+        """
+        index = to_numpy(text_index)
+        length = to_numpy(length).astype(np.int64)
+        keep = (index != 0) & (np.arange(index.shape[1]) < length[:, None])
+        keep[:, 1:] &= index[:, 1:] != index[:, :-1]  # removing repeated characters and blank.
+        texts = join_indices(self.character, index, keep)
+        if preds_max_prob is None:
+            return texts, None
+        return texts, masked_confidence(preds_max_prob, length)
 
 
 class AttnLabelConverter(object):
@@ -74,6 +119,9 @@ class AttnLabelConverter(object):
         for i, char in enumerate(self.character):
             # print(i, char)
             self.dict[char] = i
+        self.token_length = np.array([len(char) for char in self.character])
+        self.charset = get_charset(character)
+        self.char_offset = len(list_token)  # index of character[0]
 
     def encode(self, text, batch_max_length=25):
         """ convert text-label into text-index.
@@ -86,40 +134,66 @@ class AttnLabelConverter(object):
                 text[:, 0] is [GO] token and text is padded with [GO] token after [s] token.
             length : the length of output of attention decoder, which count [s] token also. [3, 7, ....] [batch_size]
         """
-        length = [len(s) + 1 for s in text]  # +1 for [s] at end of sentence.
+        batch_text, length = self.encode_batch(text, batch_max_length)
+        return (batch_text.to(device), length.to(device))
+
+    def encode_batch(self, text, batch_max_length=25):
+        """ encode on the CPU, all labels in one NumPy pass, so it can run in the DataLoader workers """
+        length, rows, cols, indices = self.lookup_batch(text)
         # batch_max_length = max(length) # this is not allowed for multi-gpu setting
         batch_max_length += 1
         # additional +1 for [GO] at first step. batch_text is padded with [GO] token after [s] token.
-        batch_text = torch.LongTensor(len(text), batch_max_length + 1).fill_(0)
-        for i, t in enumerate(text):
-            text = list(t)
-            text.append('[s]')
-            # text = [self.dict[char] for char in text]
-            text = [
-                self.dict[char] if self.dict.get(char) is not None else self.dict['[UNK]']
-                for char in text
-            ]
-            batch_text[i][1:1 + len(text)] = torch.LongTensor(text)  # batch_text[:, 0] = [GO] token
-        return (batch_text.to(device), torch.IntTensor(length).to(device))
+        batch_text = np.zeros((len(text), batch_max_length + 1), dtype=np.int64)
+        batch_text[rows, cols + 1] = indices  # batch_text[:, 0] = [GO] token
+        batch_text[np.arange(len(text)), length + 1] = self.dict['[s]']
+        length = length + 1  # +1 for [s] at end of sentence.
+        return (torch.from_numpy(batch_text), torch.from_numpy(length.astype(np.int32)))
+
+    def lookup_batch(self, text):
+        """
+        text-index of all text-labels at once through the codepoint lookup table of the charset, [UNK] if unknown.
+        The text-labels may also be int32 arrays of positions in the charset.
+        return the length of each label, and the row, column and index of every character
+        """
+        length = np.array([len(t) for t in text], dtype=np.int64)
+        if len(text) > 0 and isinstance(text[0], np.ndarray):  # charset positions, LmdbDataset(label_index=True)
+            positions = np.concatenate(text)
+        else:
+            positions = self.charset.lookup(self.charset.codepoints(''.join(text)))
+        indices = np.where(positions < 0, self.dict['[UNK]'], positions + self.char_offset)
+        rows = np.repeat(np.arange(len(text)), length)
+        cols = np.arange(len(indices)) - np.repeat(np.cumsum(length) - length, length)
+        return length, rows, cols, indices
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """
-        if len(text_index.shape) == 2:
-            texts = []
-            for index, l in enumerate(length):
-                text = ''.join([self.character[i] for i in text_index[index, :]])
-                texts.append(text)
-            return texts
-        elif len(text_index.shape) == 3:
-            topk = text_index.shape[-1]
-            all_texts = []
-            for index, l in enumerate(length):
-                texts = []
-                for k in range(topk):
-                    text = ''.join([self.character[i] for i in text_index[index, :, k]])
-                    texts.append(text)
-                all_texts.append(texts)
-            return all_texts
+        index = to_numpy(text_index)
+        if len(index.shape) == 2:
+            return join_indices(self.character, index, np.ones(index.shape, dtype=bool))
+        elif len(index.shape) == 3:
+            batch_size, steps, topk = index.shape
+            index = index.transpose(0, 2, 1).reshape(batch_size * topk, steps)
+            texts = join_indices(self.character, index, np.ones(index.shape, dtype=bool))
+            return [texts[i * topk:(i + 1) * topk] for i in range(batch_size)]
+
+    def decode_batch(self, text_index, length, preds_max_prob=None):
+        """
+        convert all text-indices into text-labels at once, pruned after "end of sentence" token ([s]).
+        With preds_max_prob [batch_size x T], also return the confidence score of each text-label, otherwise None.
+        Like the per-sample pred[:pred.find('[s]')] and pred_max_prob[:pred_EOS] it replaces, the confidence is
+        the multiply of the max probabilities of as many steps as the pruned text-label has characters,
+        and without [s] the text-label and the steps both lose their last one.
+        """
+        index = to_numpy(text_index)
+        eos = index == self.dict['[s]']
+        has_eos = eos.any(1)
+        before_eos = np.arange(index.shape[1]) < np.where(has_eos, eos.argmax(1), index.shape[1])[:, None]
+        texts = join_indices(self.character, index, before_eos)
+        texts = [text if found else text[:-1] for text, found in zip(texts, has_eos.tolist())]
+        if preds_max_prob is None:
+            return texts, None
+        pred_EOS = np.where(has_eos, (self.token_length[index] * before_eos).sum(1), index.shape[1] - 1)
+        return texts, masked_confidence(preds_max_prob, pred_EOS)
 
 
 class Averager(object):